@@ -1,7 +1,8 @@
+import copy
 import fnmatch
 import os
 import re
-import subprocess
+import stat
 import sys
 import tarfile
 import shutil
@@ -10,7 +11,13 @@ import locale
 import logging
 import tempfile
 
-from TarSCM.helpers import Helpers
+from TarSCM.helpers import Helpers, copy_file_data, copy_sparse_data, \
+    data_segments
+from TarSCM.cpio import CpioWriter, BUFSIZE
+from TarSCM.compress import ParallelCompressor, get_compression
+from TarSCM.checksum import HashingWriter
+from TarSCM.materialize import Materializer
+from TarSCM.gitobjects import GIT_MODE_TREE
 
 try:
     from io import StringIO
@@ -18,6 +25,11 @@ except:
     from StringIO import StringIO
 
 METADATA_PATTERN = re.compile(r'.*/\.(bzr|git|hg|svn)(/.*|$)')
+# Constructs which make a regex depend on what follows the matched prefix.
+# Without them, a pattern matching a directory matches everything below it.
+NOT_PREFIX_CLOSED = re.compile(r'\$|\\[bBZ]|\(\?<?[=!]')
+# characters with a special meaning in the regexes built from the patterns
+REGEX_SPECIAL = frozenset('.^$*+?()[]{}|\\')
 
 def conv_glob(string):
     string = re.sub(r'[*]', '.*', string)
@@ -26,6 +38,162 @@ def conv_glob(string):
     return string
 
 
+def literal_prefix(regex):
+    """Returns the text every string matched by regex (like re.match())
+    starts with. An empty string means that it may start with anything."""
+    depth   = 0
+    escaped = in_class = False
+    for char in regex:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth <= 0:
+            return ''
+
+    prefix = ''
+    for char in regex:
+        if char in REGEX_SPECIAL:
+            # these make the preceding character optional
+            if char in '*?{':
+                prefix = prefix[:-1]
+            break
+        prefix += char
+    return prefix
+
+
+def sparse_checkout_patterns(args):
+    """Translates --include/--include-re/--exclude into 'git sparse-checkout'
+    patterns (non-cone mode) which select at least the files FileFilter
+    packs. Whatever can't be expressed is left to FileFilter. Returns an
+    empty list if nothing can be left out."""
+    top = '/'
+    if args.subdir and args.subdir != os.curdir:
+        top = '/' + args.subdir + '/'
+
+    regexes = [conv_glob(x) for x in getattr(args, 'include', None) or []]
+    if not regexes and getattr(args, 'include_re', None):
+        regexes = [args.include_re]
+    prefixes = [literal_prefix(x) for x in regexes]
+    if prefixes and all(prefixes):
+        return [top + x + '*' for x in prefixes]
+
+    # a pattern may exclude everything starting with it, so only plain
+    # names are used, which can't remove the parent of an included path
+    excludes = [x for x in getattr(args, 'exclude', None) or []
+                if x and literal_prefix(x) == x and '/' not in x]
+    if excludes:
+        return [top + '*'] + ['!' + top + x + '*' for x in excludes]
+    return []
+
+
+class FileFilter():
+    """Include/exclude/metadata rules for the tree below topdir.
+
+    All rules are compiled once. The tree is walked top-down and
+    directories which are excluded together with everything below them
+    are pruned before they are read.
+    """
+
+    def __init__(self, topdir, args):
+        self.topdir           = topdir
+        self.package_metadata = args.package_meta
+
+        # transform glob patterns to regular expressions
+        includes  = ''
+        excludes  = r'$.'
+        excl_user = None
+        re_topdir = '(%s)/(%s)'
+
+        if args.include_re:
+            includes = re_topdir % (re.escape(topdir), args.include_re)
+
+        if args.exclude_re:
+            excl_user = args.exclude_re
+            excludes = re_topdir % (re.escape(topdir), excl_user)
+
+        if args.include:
+            incl_arr = [(conv_glob(x) + '.*') for x in args.include]
+            includes = re_topdir % (re.escape(topdir), r'|'.join(incl_arr))
+
+        if args.exclude:
+            excl_arr = [conv_glob(x) for x in args.exclude]
+            excl_user = r'|'.join(excl_arr)
+            excludes = re_topdir % (re.escape(topdir), excl_user)
+
+        if excludes:
+            logging.debug("Using exclude filter regex: %r", excludes)
+
+        self.includes = re.compile(includes)
+        self.excludes = re.compile(excludes)
+        self.prune_excludes = excl_user is not None and \
+            not NOT_PREFIX_CLOSED.search(excl_user)
+
+    def is_metadata(self, path):
+        return not self.package_metadata and METADATA_PATTERN.match(path)
+
+    def match(self, path):
+        """Returns True if path should be packed into the archive."""
+        if self.excludes.match(path):
+            return False
+        if not self.includes.match(path):
+            return False
+        return not self.is_metadata(path)
+
+    def prune(self, path):
+        """Returns True if nothing below directory path can match."""
+        if self.is_metadata(path):
+            return True
+        return self.prune_excludes and bool(self.excludes.match(path))
+
+    def walk(self):
+        """Yields the matching paths below topdir in sorted order.
+
+        Sorting a complete list would keep every path in memory and delay
+        the first entry until the whole tree is read. Instead each
+        directory is read in sorted order, where a subdirectory gets two
+        sort keys: its name for the entry itself and its name followed by
+        '/' for everything below it. This results in the order of sorted()
+        over the full paths, but only the directories on the current path
+        are held in memory.
+        """
+        stack = [iter(self._children(self.topdir))]
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                continue
+            (_, path, is_subtree) = item
+            if is_subtree:
+                stack.append(iter(self._children(path)))
+            elif self.match(path):
+                yield path
+
+    def _children(self, dirpath):
+        items = []
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError:
+            # like os.walk(), ignore unreadable directories
+            return items
+        for entry in entries:
+            path = os.path.join(dirpath, entry.name)
+            items.append((entry.name, path, False))
+            # do not descend into symlinks and excluded subtrees
+            if entry.is_dir(follow_symlinks=False) and not self.prune(path):
+                items.append((entry.name + '/', path, True))
+        items.sort()
+        return items
+
+
 class BaseArchive():
     def __init__(self):
         self.helpers        = Helpers()
@@ -38,6 +206,7 @@ class BaseArchive():
         if files is None:
             return
 
+        engine = Materializer()
         for filename in files:
             path = os.path.join(repodir, filename)
             path_glob = glob.glob(path)
@@ -50,7 +219,7 @@ class BaseArchive():
                 if not r_src.startswith(repodir):
                     sys.exit("%s: tries to escape the repository" % src)
 
-                shutil.copy2(src, outdir)
+                engine.copy_file(src, outdir)
 
     def extract_rename_from_archive(self, repodir, tuples, outdir):
         """Extract and rename all files directly outside of the archive.
@@ -58,6 +227,7 @@ class BaseArchive():
         if tuples is None:
             return
 
+        engine = Materializer()
         for pair in tuples:
             path = os.path.join(repodir, pair.split(':')[0])
 
@@ -68,58 +238,14 @@ class BaseArchive():
             if not r_src.startswith(repodir):
                 sys.exit("%s: tries to escape the repository" % path)
 
-            shutil.copy2(path, os.path.join(outdir, pair.split(':')[1]))
+            engine.copy_file(path, os.path.join(outdir, pair.split(':')[1]))
 
-    def filter_files(self, filelist, topdir, args):
+    def filter_files(self, topdir, args):
         """
-        Filter filelist by exclude/include parameters
+        Filter files below topdir by exclude/include parameters.
+        Returns a generator of the matching paths in sorted order.
         """
-        package_metadata = args.package_meta
-
-        # transform glob patterns to regular expressions
-        includes  = ''
-        excludes  = r'$.'
-        re_topdir = '(%s)/(%s)'
-
-        if args.include_re:
-            includes = re_topdir % (re.escape(topdir), args.include_re)
-
-        if args.exclude_re:
-            excludes = re_topdir % (re.escape(topdir), args.exclude_re)
-
-        if args.include:
-            incl_arr = [(conv_glob(x) + '.*') for x in args.include]
-            includes = re_topdir % (re.escape(topdir), r'|'.join(incl_arr))
-
-        if args.exclude:
-            excl_arr = [conv_glob(x) for x in args.exclude]
-            excludes = re_topdir % (re.escape(topdir), r'|'.join(excl_arr))
-
-
-        if excludes:
-            logging.debug("Using exclude filter regex: %r", excludes)
-
-        # add topdir without filtering for now
-        cpiolist = []
-        for root, dirs, files in filelist:
-            # excludes
-            dirs[:] = [os.path.join(root, d) for d in dirs]
-            dirs[:] = [d for d in dirs if not re.match(excludes, d)]
-            dirs[:] = [d for d in dirs if re.match(includes, d)]
-
-            # exclude/include files
-            files = [os.path.join(root, f) for f in files]
-            files = [f for f in files if not re.match(excludes, f)]
-            files = [f for f in files if re.match(includes, f)]
-
-            for name in dirs:
-                if not METADATA_PATTERN.match(name) or package_metadata:
-                    cpiolist.append(name)
-
-            for name in files:
-                if not METADATA_PATTERN.match(name) or package_metadata:
-                    cpiolist.append(name)
-        return sorted(cpiolist)
+        return FileFilter(topdir, args).walk()
 
 class ObsCpio(BaseArchive):
     def create_archive(self, scm_object, **kwargs):
@@ -132,49 +258,33 @@ class ObsCpio(BaseArchive):
         commit           = scm_object.get_current_commit()
 
         (workdir, topdir) = os.path.split(scm_object.arch_dir)
+        tstamp = self.helpers.get_timestamp(scm_object, args, topdir)
+        # the rest only reads the copy, so other runs can use the cache
+        scm_object.unlock_cache(arch_only=True)
         extension = 'obscpio'
 
         cwd = os.getcwd()
         os.chdir(workdir)
 
         archivefilename = os.path.join(args.outdir, dstname + '.' + extension)
-        archivefile     = open(archivefilename, "w")
-
-        # detect reproducible support
-        params = ['cpio', '--create', '--format=newc', '--owner', '0:0']
-        chkcmd = "cpio --create --format=newc --reproducible "
-        chkcmd += "</dev/null >/dev/null 2>&1"
-        if os.system(chkcmd) == 0:
-            params.append('--reproducible')
-
-        proc = subprocess.Popen(
-            params,
-            shell  = False,
-            stdin  = subprocess.PIPE,
-            stdout = archivefile,
-            stderr = subprocess.STDOUT
-        )
-        filelist = os.walk(topdir, topdown=False)
-        tstamp = self.helpers.get_timestamp(scm_object, args, topdir)
-        for name in self.filter_files(filelist, topdir, args):
-            try:
-                os.utime(name, (tstamp, tstamp), follow_symlinks=False)
-            except OSError:
-                pass
-            # bytes() break in python2 with a TypeError as it expects only 1
-            # arg
-            try:
-                proc.stdin.write(name.encode('UTF-8', 'surrogateescape'))
-            except (TypeError, UnicodeDecodeError):
-                proc.stdin.write(name)
-
-            proc.stdin.write(b"\n")
-        proc.stdin.close()
-        ret_code = proc.wait()
-        if ret_code != 0:
-            raise SystemExit("Creating the cpio archive failed!")
+        archivefile     = open(archivefilename, "wb", buffering=BUFSIZE)
+        output          = archivefile
+        if args.checksum:
+            output = HashingWriter(archivefile, args.checksum)
+
+        cpio = CpioWriter(output, tstamp)
+        if scm_object.object_tree:
+            self.add_objects(cpio, scm_object.object_tree, topdir, args)
+        else:
+            for name in self.filter_files(topdir, args):
+                cpio.add(name)
+        cpio.close()
         archivefile.close()
 
+        checksums = []
+        if args.checksum:
+            checksums = output.write_sidecars(archivefilename)
+
         # write meta data
         infofile = os.path.join(args.outdir, basename + '.obsinfo')
         logging.debug("Writing to obsinfo file '%s'", infofile)
@@ -186,14 +296,150 @@ class ObsCpio(BaseArchive):
         if commit:
             metafile.write("commit: " + commit + "\n")
 
+        if checksums:
+            metafile.write("checksum: " + ' '.join(checksums) + "\n")
+
         metafile.close()
 
         self.archivefile    = archivefile.name
         self.metafile       = metafile.name
         os.chdir(cwd)
 
+    def add_objects(self, cpio, tree, topdir, args):
+        """Add the matching entries of a git tree straight from the object
+        database."""
+        store = tree.store
+        for (name, mode, sha) in tree.walk(args.subdir,
+                                           FileFilter(topdir, args)):
+            if stat.S_ISREG(mode):
+                (_, size) = store.open(sha)
+                cpio.add_entry(name, mode, size, fileobj=store.stdout)
+                store.done()
+            elif stat.S_ISLNK(mode):
+                cpio.add_entry(name, mode, data=store.read(sha))
+            else:
+                cpio.add_entry(name, mode)
+
 
 class Tar(BaseArchive):
+    def add_entry(self, tar, name, reset, sparse=False):
+        """Add a single file system entry to the open tarfile.
+
+        Unlike tar.add(), which copies file contents through python,
+        the header is built from the stat result and the payload of
+        regular files is transferred by copy_file_data(). Holes in sparse
+        files are not read. If sparse is True, files with holes are
+        stored as PAX sparse members.
+        """
+        tarinfo = tar.gettarinfo(name)
+        if tarinfo is None:
+            logging.debug("tarfile: Unsupported type %r", name)
+            return
+        tarinfo = reset(tarinfo)
+
+        buf = tarinfo.tobuf(tar.format, tar.encoding, tar.errors)
+        if not tarinfo.isreg() or not tarinfo.size:
+            tar.fileobj.write(buf)
+            tar.offset += len(buf)
+            tar.members.append(tarinfo)
+            return
+
+        with open(name, 'rb', buffering=0) as src:
+            segments = data_segments(src.fileno(), tarinfo.size)
+            if sparse and segments is not None and \
+                    sum(length for (_, length) in segments) < tarinfo.size:
+                self.add_sparse_entry(tar, tarinfo, src, segments)
+                return
+            tar.fileobj.write(buf)
+            tar.offset += len(buf)
+            copied = copy_sparse_data(src, tar.fileobj, tarinfo.size,
+                                      segments=segments)
+            if copied != tarinfo.size:
+                raise SystemExit("%s: file changed while creating the "
+                                 "tarball" % name)
+        self._pad_member(tar, tarinfo.size)
+        tar.members.append(tarinfo)
+
+    def add_sparse_entry(self, tar, tarinfo, src, segments):
+        """Store a regular file as sparse member in PAX format 1.0, which
+        GNU tar, bsdtar and python's tarfile understand.
+
+        The member is named '<dir>/GNUSparseFile.0/<name>' and its data
+        starts with the map of the data regions, followed by the regions
+        themselves.
+        """
+        realsize = tarinfo.size
+        if not segments or sum(segments[-1]) < realsize:
+            # the map always ends at the real size of the file
+            segments = segments + [(realsize, 0)]
+        sparse_map = '%d\n' % len(segments)
+        sparse_map += ''.join('%d\n%d\n' % seg for seg in segments)
+        sparse_map = sparse_map.encode('ascii')
+        sparse_map += tarfile.NUL * (-len(sparse_map) % tarfile.BLOCKSIZE)
+
+        member = copy.copy(tarinfo)
+        (dirname, basename) = os.path.split(tarinfo.name)
+        member.name = os.path.join(dirname, 'GNUSparseFile.0', basename)
+        member.size = len(sparse_map) + sum(ln for (_, ln) in segments)
+        member.pax_headers = dict(tarinfo.pax_headers)
+        member.pax_headers.update({
+            'GNU.sparse.major':    '1',
+            'GNU.sparse.minor':    '0',
+            'GNU.sparse.name':     tarinfo.name,
+            'GNU.sparse.realsize': str(realsize),
+        })
+
+        buf = member.tobuf(tarfile.PAX_FORMAT, tar.encoding, tar.errors)
+        tar.fileobj.write(buf + sparse_map)
+        tar.offset += len(buf)
+        for (start, length) in segments:
+            src.seek(start)
+            if copy_file_data(src, tar.fileobj, length) != length:
+                raise SystemExit("%s: file changed while creating the "
+                                 "tarball" % tarinfo.name)
+        self._pad_member(tar, member.size)
+        tar.members.append(tarinfo)
+
+    def _pad_member(self, tar, size):
+        blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+        if remainder:
+            tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        tar.offset += blocks * tarfile.BLOCKSIZE
+
+    def add_files(self, tar, topdir, args, reset):
+        """Add topdir and the matching files below it to the tarball."""
+        try:
+            tar.add(topdir, recursive=False, filter=reset)
+        except TypeError:
+            # Python 2.6 compatibility
+            tar.add(topdir, recursive=False)
+        # the paths are unique, so every entry is added only once
+        for entry in self.filter_files(topdir, args):
+            logging.debug("Adding filtered file: %s", entry)
+            self.add_entry(tar, entry, reset, args.sparse)
+
+    def add_objects(self, tar, tree, topdir, args, reset):
+        """Add topdir and the matching entries of a git tree straight from
+        the object database."""
+        store   = tree.store
+        entries = [(topdir, tree.mode(GIT_MODE_TREE), None)]
+        entries += tree.walk(args.subdir, FileFilter(topdir, args))
+        for (name, mode, sha) in entries:
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.mode = stat.S_IMODE(mode)
+            if stat.S_ISREG(mode):
+                (_, tarinfo.size) = store.open(sha)
+                tar.addfile(reset(tarinfo), store.stdout)
+                store.done()
+                continue
+            if stat.S_ISLNK(mode):
+                tarinfo.type = tarfile.SYMTYPE
+                tarinfo.linkname = os.fsdecode(store.read(sha))
+            else:
+                tarinfo.type = tarfile.DIRTYPE
+            tar.addfile(reset(tarinfo))
+
     def create_archive(self, scm_object, **kwargs):
         """Create a tarball of repodir in destination directory."""
         (workdir, topdir) = os.path.split(scm_object.arch_dir)
@@ -210,6 +456,8 @@ class Tar(BaseArchive):
             args,
             scm_object.clone_dir
         )
+        # the rest only reads the copy, so other runs can use the cache
+        scm_object.unlock_cache(arch_only=True)
 
         incl_patterns = []
         excl_patterns = []
@@ -239,27 +487,37 @@ class Tar(BaseArchive):
         enc = locale.getpreferredencoding()
 
         out_file = os.path.join(outdir, dstname + '.' + extension)
-        filelist = os.walk(topdir, topdown=False)
-
-        files_added = dict()
-
-        with tarfile.open(out_file, "w", encoding=enc) as tar:
-            try:
-                tar.add(topdir, recursive=False, filter=reset)
-            except TypeError:
-                # Python 2.6 compatibility
-                tar.add(topdir, recursive=False)
-            for entry in self.filter_files(filelist, topdir, args):
-                logging.debug("Filtered file: %s", entry)
-                if not files_added.get(entry, False):
-                    logging.debug("Adding filtered file: %s", entry)
-                    try:
-                        tar.add(entry, recursive=False, filter=reset)
-                    except TypeError:
-                        # Python 2.6 compatibility
-                        tar.add(entry, exclude=tar_exclude)
-                    files_added[entry] = True
-                    logging.debug("Added filtered file: %s", entry)
+
+        compression = get_compression(extension)
+        outfile = compressor = hasher = fileobj = None
+        if compression or args.checksum:
+            outfile = fileobj = open(out_file, 'wb')
+        if args.checksum:
+            # the checksums are calculated over the final file content
+            hasher = fileobj = HashingWriter(outfile, args.checksum)
+        if compression:
+            logging.debug("Compressing archive with '%s'", compression)
+            compressor = fileobj = ParallelCompressor(fileobj, compression)
+
+        try:
+            with tarfile.open(out_file, "w", fileobj=fileobj,
+                              encoding=enc) as tar:
+                if scm_object.object_tree:
+                    self.add_objects(tar, scm_object.object_tree, topdir,
+                                     args, reset)
+                else:
+                    self.add_files(tar, topdir, args, reset)
+            if compressor:
+                compressor.close()
+        except BaseException:
+            # stop the workers without compressing the rest
+            if compressor:
+                compressor.abort()
+            raise
+        if outfile:
+            outfile.close()
+        if hasher:
+            hasher.write_sidecars(out_file)
 
         self.archivefile    = tar.name
 
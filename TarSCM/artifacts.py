@@ -0,0 +1,219 @@
+'''
+This module contains the class ArtifactCache
+'''
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from TarSCM.config import Config
+from TarSCM.materialize import Materializer
+
+# bump whenever the content of the generated artifacts changes for the
+# same input, so that old cache entries are not used anymore
+CACHE_FORMAT = 1
+
+# arguments which influence the content of the generated artifacts
+KEY_ARGS = [
+    'scm', 'url', 'subdir', 'include', 'include_re', 'exclude',
+    'exclude_re', 'extract', 'extract_rename', 'extension', 'package_meta',
+    'submodules', 'lfs', 'use_obs_scm', 'filename', 'without_version',
+    'encoding', 'checksum', 'sparse',
+]
+
+# arguments which don't influence the result of a run at all
+PROBE_IGNORED_ARGS = [
+    'outdir', 'verbose', 'skip_cleanup', 'history_depth', 'probe_remote',
+]
+
+
+def caching_enabled():
+    '''Returns True if CACHE_ARTIFACTS is enabled in the environment or
+    in the config.'''
+    value = os.getenv('CACHE_ARTIFACTS')
+    if value is None:
+        value = Config().get('tar_scm', 'CACHE_ARTIFACTS')
+    return str(value).lower() in ['1', 'yes', 'true', 'enable']
+
+
+class ArtifactCache():
+    '''
+    Content addressed cache for the files which a task writes to the
+    outdir (archive, obsinfo and extracted files).
+
+    The entries are stored in '<CACHEDIRECTORY>/artifacts/<key>', where
+    key is a hash over the commit and all parameters which influence the
+    content of the artifacts. An entry only exists after it has been
+    completely written, so concurrent runs either see all files or none.
+    Caching has to be enabled with CACHE_ARTIFACTS or --probe-remote,
+    because every entry is another copy of the artifacts on disk.
+    '''
+    def __init__(self, cachedir, key, commit=None):
+        self.basedir   = os.path.join(cachedir, 'artifacts')
+        self.key       = key
+        self.entry_dir = os.path.join(self.basedir, key)
+        self.commit    = commit
+
+    @classmethod
+    def for_task(cls, scm_object, args, **kwargs):
+        '''
+        Returns an ArtifactCache for the current task or None if caching
+        is disabled or not possible (no cache directory or no immutable
+        revision).
+        '''
+        cachedir = scm_object.cachedir
+        if not cachedir or args.use_obs_gbp:
+            return None
+        if not getattr(args, 'probe_remote', False) and \
+           not caching_enabled():
+            return None
+
+        # submodules following a branch are not pinned by the commit
+        if getattr(args, 'submodules', None) in ['main', 'master']:
+            return None
+
+        commit = scm_object.get_current_commit()
+        if not commit:
+            return None
+
+        params = dict((arg, getattr(args, arg, None)) for arg in KEY_ARGS)
+        params.update(kwargs)
+        params['commit'] = commit
+        params['format'] = CACHE_FORMAT
+        data = json.dumps(params, sort_keys=True, default=str)
+        key  = hashlib.sha256(data.encode('UTF-8')).hexdigest()
+        logging.debug("ARTIFACT CACHE KEY: %s (%s)", key, data)
+        return cls(cachedir, key, commit)
+
+    def files(self):
+        '''Returns the names of the cached files or None on a miss.'''
+        if not os.path.isdir(self.entry_dir):
+            return None
+        return sorted(os.listdir(self.entry_dir))
+
+    def restore(self, outdir):
+        '''
+        Copy all files of the cache entry into outdir. Returns False on a
+        cache miss.
+
+        Files are reflinked if the filesystem supports it and copied
+        otherwise, never hardlinked, because later services might edit
+        them in place.
+        '''
+        names = self.files()
+        if names is None:
+            return False
+
+        engine = Materializer()
+        for name in names:
+            src = os.path.join(self.entry_dir, name)
+            dst = os.path.join(outdir, name)
+            method = engine.copy_file(src, dst, hardlink=False)
+            logging.debug("Restored '%s' from artifact cache (%s)", name,
+                          method)
+
+        # update atime and mtime to make it easier to expire old entries
+        os.utime(self.entry_dir, (time.time(), time.time()))
+        return True
+
+    def store(self, outdir, names):
+        '''
+        Store the files names from outdir in the cache. Only regular files
+        are cached. Nothing is stored if the entry already exists.
+        '''
+        if os.path.isdir(self.entry_dir):
+            return
+        for name in names:
+            if not stat.S_ISREG(os.lstat(os.path.join(outdir, name)).st_mode):
+                logging.debug("Not caching artifacts: '%s' is no regular file",
+                              name)
+                return
+
+        if not os.path.isdir(self.basedir):
+            os.makedirs(self.basedir)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.basedir)
+        engine = Materializer()
+        try:
+            for name in names:
+                engine.copy_file(os.path.join(outdir, name),
+                                 os.path.join(tmpdir, name))
+            os.rename(tmpdir, self.entry_dir)
+        except OSError as exc:
+            # another run stored the same entry in the meantime
+            logging.debug("Could not store artifacts: %s", exc)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        logging.debug("Stored artifacts in '%s': %s", self.entry_dir,
+                      ' '.join(names))
+
+
+class ProbeRecord():
+    '''
+    Remembers the commit and the artifact cache entry of the last run with
+    exactly the same parameters, so that a later run only has to ask
+    upstream for its current commit (see Scm.remote_revision()) to tell
+    whether it can reuse the entry.
+
+    The records are stored in '<CACHEDIRECTORY>/probes/<key>.json', where
+    key is a hash over all parameters of the run.
+    '''
+    def __init__(self, cachedir, args):
+        params = dict((arg, value) for arg, value in vars(args).items()
+                      if arg not in PROBE_IGNORED_ARGS)
+        # the tar, snapcraft and appimage services name the archives
+        # differently
+        params['service'] = os.path.basename(sys.argv[0])
+        params['format']  = CACHE_FORMAT
+        data = json.dumps(params, sort_keys=True, default=str)
+        key  = hashlib.sha256(data.encode('UTF-8')).hexdigest()
+        self.cachedir = cachedir
+        self.basedir  = os.path.join(cachedir, 'probes')
+        self.path     = os.path.join(self.basedir, key + '.json')
+
+    def lookup(self, commit):
+        '''
+        Returns the ArtifactCache which was recorded for commit or None if
+        there is none.
+        '''
+        try:
+            with open(self.path) as record:
+                data = json.load(record)
+        except (IOError, OSError, ValueError):
+            return None
+        if data.get('commit') != commit:
+            return None
+        cache = ArtifactCache(self.cachedir, data['entry'], commit)
+        if cache.files() is None:
+            return None
+        return cache
+
+    def store(self, cache):
+        '''Record the entry of cache.'''
+        data = {'commit': cache.commit, 'entry': cache.key}
+        if not os.path.isdir(self.basedir):
+            os.makedirs(self.basedir)
+        (fdesc, tmpname) = tempfile.mkstemp(prefix='.tmp-', dir=self.basedir)
+        with os.fdopen(fdesc, 'w') as record:
+            json.dump(data, record)
+        os.rename(tmpname, self.path)
+
+
+def snapshot_dir(dirname):
+    '''Returns a dict of the names in dirname and their stat signature.'''
+    result = {}
+    for name in os.listdir(dirname):
+        fstat = os.lstat(os.path.join(dirname, name))
+        result[name] = (fstat.st_mode, fstat.st_size, fstat.st_mtime_ns,
+                        fstat.st_ino)
+    return result
+
+
+def changed_files(before, after):
+    '''Returns the sorted names which are new or have changed.'''
+    return sorted(name for name, sig in after.items()
+                  if before.get(name) != sig)
@@ -0,0 +1,50 @@
+import hashlib
+import logging
+import os
+
+# algorithm -> constructor, the names are also used as file suffix
+CHECKSUMS = {
+    'sha256':  hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+
+
+class HashingWriter():
+    """Write-only file object which hashes all data written to fileobj.
+
+    It does not expose a file descriptor, so everything written through
+    it passes the hash functions instead of being copied in the kernel.
+    """
+
+    def __init__(self, fileobj, algorithms):
+        self.fileobj = fileobj
+        self.hashes  = [(algo, CHECKSUMS[algo]()) for algo in algorithms]
+        self.offset  = 0
+
+    def write(self, data):
+        for (_, hsh) in self.hashes:
+            hsh.update(data)
+        self.offset += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigests(self):
+        """Returns a list of (algorithm, hexdigest)."""
+        return [(algo, hsh.hexdigest()) for (algo, hsh) in self.hashes]
+
+    def write_sidecars(self, filename):
+        """Write '<filename>.<algorithm>' in the format of sha256sum/b2sum
+        and return the digests in the form 'algorithm:hexdigest'."""
+        result = []
+        for (algo, digest) in self.hexdigests():
+            sidecar = filename + '.' + algo
+            logging.debug("Writing checksum file '%s'", sidecar)
+            with open(sidecar, 'w') as sfh:
+                sfh.write("%s  %s\n" % (digest, os.path.basename(filename)))
+            result.append(algo + ':' + digest)
+        return result
@@ -66,6 +66,43 @@ def check_locale(loc):
     return 'C'
 
 
+def add_filter_arguments(parser):
+    """Add the options which select the files to pack."""
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--include', action='append',
+                       default=[], metavar='REGEXP',
+                       help='Specifies subset of files/subdirectories to '
+                            'pack in the tarball (can be repeated)')
+    group.add_argument('--include-re',
+                       metavar='REGEXP',
+                       help='Specifies a regex pattern to match '
+                            'files/subdirectories to pack in the archive')
+    group.add_argument('--exclude', action='append',
+                       default=[], metavar='REGEXP',
+                       help='Specifies excludes when creating the '
+                            'tarball (can be repeated)')
+    group.add_argument('--exclude-re',
+                       metavar='REGEXP',
+                       help='Specifies a regex pattern to exclude matching'
+                            ' files from the archive')
+
+
+def booleanize_args(args):
+    """Convert the non-standard boolean parameters to bool."""
+    args.changesgenerate      = bool(args.changesgenerate == 'enable')
+    args.package_meta         = bool(args.package_meta == 'yes')
+    args.sslverify            = bool(args.sslverify != 'disable')
+    args.stream_objects       = bool(args.stream_objects == 'enable')
+    args.sparse               = bool(args.sparse == 'enable')
+    args.probe_remote         = bool(args.probe_remote == 'enable')
+    args.use_obs_scm          = bool(args.use_obs_scm)
+    args.use_obs_gbp          = bool(args.use_obs_gbp)
+    args.latest_signed_commit = bool(args.latest_signed_commit)
+    args.latest_signed_tag    = bool(args.latest_signed_tag)
+    t_gbp_dch_release_u = bool(args.gbp_dch_release_update != 'disable')
+    args.gbp_dch_release_update = t_gbp_dch_release_u
+
+
 class Cli():
     # pylint: disable=too-few-public-methods
     # pylint: disable=too-many-instance-attributes
@@ -143,7 +180,15 @@ class Cli():
                                  ' to determine tarball name')
         parser.add_argument('--extension', default='tar',
                             help='suffix name of package - used together with '
-                                 'filename to determine tarball name')
+                                 'filename to determine tarball name. '
+                                 'tar.gz, tar.xz and tar.zst create a '
+                                 'compressed tarball')
+        parser.add_argument('--checksum', action='append', default=[],
+                            choices=['sha256', 'blake2b'],
+                            help='Write a checksum file <archive>.<algorithm>'
+                                 ' (and a checksum line to the obsinfo file)'
+                                 ' while the archive is created (can be '
+                                 'repeated)')
         parser.add_argument('--changesgenerate', choices=['enable', 'disable'],
                             default='disable',
                             help='Specify whether to generate changes file '
@@ -171,27 +216,30 @@ class Cli():
                             help='Whether or not to include git lfs blobs '
                                  'from SCM commit log since a given parent '
                                  'revision (see changesrevision).')
+        parser.add_argument('--sparse',
+                            choices=['enable', 'disable'],
+                            default='disable',
+                            help='Store files with holes as sparse members '
+                                 'in tarballs. The result depends on how the '
+                                 'filesystem allocated the files.')
+        parser.add_argument('--stream-objects',
+                            choices=['enable', 'disable'],
+                            default='disable',
+                            help='Build the archive straight from the git '
+                                 'object database instead of copying a '
+                                 'checked out working copy.')
+        parser.add_argument('--probe-remote',
+                            choices=['enable', 'disable'],
+                            default='disable',
+                            help='Ask upstream for the commit of the revision '
+                                 'first and reuse the cached artifacts of the '
+                                 'last run with the same parameters if it did '
+                                 'not change.')
         parser.add_argument('--sslverify', choices=['enable', 'disable'],
                             default='enable',
                             help='Whether or not to check server certificate '
                                  'against installed CAs.')
-        group = parser.add_mutually_exclusive_group()
-        group.add_argument('--include', action='append',
-                           default=[], metavar='REGEXP',
-                           help='Specifies subset of files/subdirectories to '
-                                'pack in the tarball (can be repeated)')
-        group.add_argument('--include-re',
-                           metavar='REGEXP',
-                           help='Specifies a regex pattern to match '
-                                'files/subdirectories to pack in the archive')
-        group.add_argument('--exclude', action='append',
-                           default=[], metavar='REGEXP',
-                           help='Specifies excludes when creating the '
-                                'tarball (can be repeated)')
-        group.add_argument('--exclude-re',
-                           metavar='REGEXP',
-                           help='Specifies a regex pattern to exclude matching'
-                                ' files from the archive')
+        add_filter_arguments(parser)
         parser.add_argument('--package-meta',
                             choices=['yes', 'no'], default='no',
                             help='Package the meta data of SCM to allow the '
@@ -270,16 +318,7 @@ class Cli():
         if args.filename and "/" in args.filename:
             sys.exit('--filename must not specify a path')
 
-        # booleanize non-standard parameters
-        args.changesgenerate      = bool(args.changesgenerate == 'enable')
-        args.package_meta         = bool(args.package_meta == 'yes')
-        args.sslverify            = bool(args.sslverify != 'disable')
-        args.use_obs_scm          = bool(args.use_obs_scm)
-        args.use_obs_gbp          = bool(args.use_obs_gbp)
-        args.latest_signed_commit = bool(args.latest_signed_commit)
-        args.latest_signed_tag    = bool(args.latest_signed_tag)
-        t_gbp_dch_release_u = bool(args.gbp_dch_release_update != 'disable')
-        args.gbp_dch_release_update = t_gbp_dch_release_u
+        booleanize_args(args)
 
         if args.latest_signed_commit and args.latest_signed_tag:
             sys.exit('--latest-signed-commit '
@@ -0,0 +1,121 @@
+import collections
+import gzip
+import lzma
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+ZSTD_IMPORT_ERROR = 0
+
+try:
+    import zstandard
+except ImportError:
+    ZSTD_IMPORT_ERROR = 1
+
+
+def _compress_gz(data):
+    # mtime=0 keeps the member headers reproducible
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _compress_xz(data):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64,
+                         preset=6)
+
+
+def _compress_zst(data):
+    return zstandard.ZstdCompressor(level=19).compress(data)
+
+
+# extension -> (compression function, uncompressed block size, memory of
+#               the encoder)
+#
+# Every block is compressed into a complete gzip member, xz stream or
+# zstd frame. Concatenations of those are valid files for all three
+# formats, so blocks can be compressed independently and the output
+# only depends on the input and the block size, not on the number of
+# workers.
+COMPRESSIONS = {
+    'tar.gz':  (_compress_gz, 1024 * 1024, 1024 * 1024),
+    'tar.xz':  (_compress_xz, 24 * 1024 * 1024, 96 * 1024 * 1024),
+    'tar.zst': (_compress_zst, 8 * 1024 * 1024, 96 * 1024 * 1024),
+}
+
+# upper bounds for the workers and the memory of the blocks in flight and
+# the encoders, independent of the number of CPUs of the build host
+MAX_WORKERS  = 8
+MEMORY_LIMIT = 512 * 1024 * 1024
+
+
+def get_compression(extension):
+    """Returns the compression matching extension or None."""
+    if extension not in COMPRESSIONS:
+        return None
+    if extension == 'tar.zst' and ZSTD_IMPORT_ERROR:
+        raise SystemExit('Error while importing zstandard but "--extension"'
+                         ' is set to "tar.zst". Please install zstandard!')
+    return extension
+
+
+class ParallelCompressor():
+    """Write-only file object which compresses blocks in parallel.
+
+    Written data is split into fixed size blocks, which are compressed
+    by a pool of threads (zlib, lzma and zstandard release the GIL) and
+    written to fileobj in their original order. At most two blocks per
+    worker are kept in memory. The number of workers is limited, so that
+    these blocks and the encoders stay within MEMORY_LIMIT.
+    """
+
+    def __init__(self, fileobj, compression, workers=None):
+        self.fileobj = fileobj
+        (self.compress, self.blocksize,
+         encoder_memory) = COMPRESSIONS[compression]
+        # a running block needs its input and output, a waiting one the
+        # input or the result
+        worker_memory = encoder_memory + 3 * self.blocksize
+        self.workers = max(1, min(workers or os.cpu_count() or 1,
+                                  MAX_WORKERS,
+                                  MEMORY_LIMIT // worker_memory))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = collections.deque()
+        self.buf = bytearray()
+        self.offset = 0
+        self.blocks = 0
+
+    def write(self, data):
+        self.buf += data
+        self.offset += len(data)
+        while len(self.buf) >= self.blocksize:
+            self._submit(bytes(self.buf[:self.blocksize]))
+            del self.buf[:self.blocksize]
+        return len(data)
+
+    def tell(self):
+        # tarfile only needs the uncompressed position
+        return self.offset
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(self.compress, block))
+        self.blocks += 1
+        while len(self.pending) > 2 * self.workers:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        """Compress the rest and write all blocks to fileobj."""
+        try:
+            if self.buf or not self.blocks:
+                self._submit(bytes(self.buf))
+                self.buf = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.abort()
+
+    def abort(self):
+        """Drop the blocks which have not been written and stop the
+        workers."""
+        while self.pending:
+            self.pending.popleft().cancel()
+        self.buf = bytearray()
+        self.executor.shutdown()
@@ -0,0 +1,100 @@
+import os
+import stat
+
+from TarSCM.helpers import copy_sparse_data
+
+# size of the chunks used to copy file contents into the archive
+BUFSIZE      = 1024 * 1024
+NEWC_MAGIC   = b'070701'
+NEWC_TRAILER = 'TRAILER!!!'
+# cpio pads the whole archive to a multiple of its block size
+BLOCKSIZE    = 512
+# all numeric header fields are 8 hex digits wide
+MAX_FIELD    = 0xFFFFFFFF
+
+
+def encode_name(name):
+    # bytes() break in python2 with a TypeError as it expects only 1 arg
+    try:
+        return name.encode('UTF-8', 'surrogateescape')
+    except (TypeError, UnicodeDecodeError):
+        return name
+
+
+def _padding(length):
+    return b'\0' * (-length % 4)
+
+
+class CpioWriter():
+    """Streaming writer for reproducible cpio archives in "newc" format.
+
+    The result is equivalent to
+    'cpio --create --format=newc --owner 0:0 --reproducible' on a tree
+    whose mtimes have been set to the commit timestamp, but all normalized
+    values (mtime, uid/gid, inode and device numbers, link count) are
+    written straight into the headers, so the files on disk stay untouched.
+    """
+
+    def __init__(self, fileobj, mtime):
+        self.fileobj = fileobj
+        self.mtime   = int(mtime)
+        self.offset  = 0
+        self._ino    = 0
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def _write_header(self, name, mode, size, ino, nlink=1, rdev=0):
+        bname = encode_name(name) + b'\0'
+        if size > MAX_FIELD:
+            raise SystemExit("%s: file too large for cpio archive" % name)
+        fields = (ino, mode, 0, 0, nlink, self.mtime, size,
+                  0, 0, os.major(rdev), os.minor(rdev), len(bname), 0)
+        header = NEWC_MAGIC + b''.join(b'%08X' % fld for fld in fields)
+        header += bname
+        self._write(header + _padding(len(header)))
+
+    def add_entry(self, name, mode, size=0, fileobj=None, data=None,
+                  rdev=0):
+        """Add a single entry to the archive.
+
+        The payload is either given as bytes in ``data`` or read from
+        ``fileobj``, which must provide exactly ``size`` bytes. Holes of
+        sparse files are not read but written as zeros, as newc has no
+        notion of sparse files.
+        """
+        self._ino += 1
+        nlink = 2 if stat.S_ISDIR(mode) else 1
+        if data is not None:
+            size = len(data)
+        self._write_header(name, mode, size, self._ino, nlink, rdev)
+
+        if data is not None:
+            self._write(data)
+        elif fileobj is not None:
+            copied = copy_sparse_data(fileobj, self.fileobj, size, BUFSIZE)
+            self.offset += copied
+            if copied != size:
+                raise SystemExit("%s: file changed while creating the cpio"
+                                 " archive" % name)
+        self._write(_padding(size))
+
+    def add(self, name):
+        """Add a file, directory or symlink from the filesystem."""
+        fstat = os.lstat(name)
+        mode  = fstat.st_mode
+        if stat.S_ISREG(mode):
+            with open(name, 'rb', buffering=0) as src:
+                self.add_entry(name, mode, fstat.st_size, fileobj=src)
+        elif stat.S_ISLNK(mode):
+            self.add_entry(name, mode, data=encode_name(os.readlink(name)))
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            self.add_entry(name, mode, rdev=fstat.st_rdev)
+        else:
+            self.add_entry(name, mode)
+
+    def close(self):
+        """Write the trailer and pad the archive to full blocks."""
+        self._write_header(NEWC_TRAILER, 0, 0, 0)
+        self._write(b'\0' * (-self.offset % BLOCKSIZE))
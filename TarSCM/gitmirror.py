@@ -0,0 +1,168 @@
+'''
+This module contains the helpers for the mirror cache and the history
+depth of git repositories
+'''
+import os
+import re
+
+from TarSCM.gitobjects import FULL_SHA
+from TarSCM.helpers import Helpers
+
+# revision expressions like 'a/b~1', which can't be a ref name
+NO_REF_NAME = re.compile(r'[~^:?*[\\\s]|\.\.|//|@\{|\.lock(/|$)|/$')
+# revisions which might be a (possibly abbreviated) commit id
+COMMIT_ID = re.compile(r'^[0-9a-f]{4,40}$')
+
+
+def is_shallow(repo_dir):
+    '''Returns True if repo_dir (bare or not) is a shallow repository.'''
+    if not repo_dir:
+        return False
+    return os.path.exists(os.path.join(repo_dir, 'shallow')) or \
+        os.path.exists(os.path.join(repo_dir, '.git', 'shallow'))
+
+
+def shallow_commits(repo_dir):
+    '''Returns the commits at the boundary of a shallow repository, whose
+    parents are missing.'''
+    for shallow in (os.path.join(repo_dir, 'shallow'),
+                    os.path.join(repo_dir, '.git', 'shallow')):
+        if os.path.exists(shallow):
+            with open(shallow) as sfh:
+                return set(sfh.read().split())
+    return set()
+
+
+def history_depth(args):
+    '''
+    Returns 1 if a run only needs the packaged commit itself or None if it
+    needs the complete history: for changes entries, signed commits and
+    tags, the packed metadata, git-buildpackage or revisions which might
+    be older commits.
+
+    Parent tags (@PARENT_TAG@, @TAG_OFFSET@) don't need the complete
+    history, a shallow clone gets deepened until it reaches the tag (see
+    needs_parent_tag()).
+    '''
+    needs_history = [getattr(args, name, False)
+                     for name in ('changesgenerate', 'latest_signed_commit',
+                                  'latest_signed_tag', 'package_meta',
+                                  'use_obs_gbp')]
+    if any(needs_history):
+        return None
+    # commits older than the shallow history can't be fetched by name
+    revision = args.revision or ''
+    if COMMIT_ID.match(revision) or NO_REF_NAME.search(revision):
+        return None
+    return 1
+
+
+def clone_branch(revision):
+    '''
+    Returns the revision if a shallow clone can fetch it by name with
+    'git clone --branch', which only accepts branches and tags, or None.
+    Names with '/' might be other refs like 'pull/1/head', which are
+    fetched after the clone.
+    '''
+    if not revision or revision == 'HEAD' or '/' in revision or \
+       revision.startswith('@'):
+        return None
+    return revision
+
+
+def needs_parent_tag(args):
+    '''Returns True if the run expands @PARENT_TAG@ or @TAG_OFFSET@.'''
+    for value in (args.revision, getattr(args, 'versionformat', None)):
+        if value and ('@PARENT_TAG@' in value or '@TAG_OFFSET@' in value):
+            return True
+    return False
+
+
+def parent_tag_reached(scmcmd, repo_dir, rev, match_tag=None):
+    '''Returns True if repo_dir is complete or no commit between rev and
+    its parent tag lacks its parents.'''
+    shallow = shallow_commits(repo_dir)
+    if not shallow:
+        return True
+    cmd = scmcmd + ['describe', '--tags', '--abbrev=0']
+    if match_tag:
+        cmd.append('--match=%s' % match_tag)
+    rcode, tag = Helpers().run_cmd(cmd + [rev], repo_dir)
+    if rcode:
+        return False
+    cmd = scmcmd + ['rev-list', tag.strip() + '..' + rev]
+    rcode, commits = Helpers().run_cmd(cmd, repo_dir)
+    return not rcode and not shallow.intersection(commits.split())
+
+
+def depth_args(repo_dir, depth=None):
+    '''
+    Returns the arguments for a fetch into repo_dir, which keep a shallow
+    repository at depth or complete it if depth is None.
+
+    Mirrors created by older versions might be shallow, but working copies
+    can only borrow the objects of a complete mirror: 'git clone --shared'
+    silently copies the objects of a shallow repository and
+    'git clone --reference' refuses it.
+    '''
+    if not is_shallow(repo_dir):
+        return []
+    if depth:
+        return ['--depth', str(depth)]
+    return ['--unshallow']
+
+
+def _needs_full_refspecs(args, revision):
+    '''Returns True if the run needs all tags instead of only the ones
+    matching --match-tag.'''
+    match = getattr(args, 'match_tag', None)
+    # only a single '*' is a refspec pattern as well
+    if not match or match.count('*') != 1:
+        return True
+    if any(char in match for char in '?[\\'):
+        return True
+    if getattr(args, 'latest_signed_tag', False):
+        return True
+    if revision in ('', '@PARENT_TAG@') or FULL_SHA.match(revision):
+        return False
+    # any other revision might name a tag itself
+    return not revision.startswith('refs/')
+
+
+def mirror_refspecs(args, revision):
+    '''
+    Returns the refspecs of the refs a run needs: all branches, the tags
+    matching --match-tag and a requested ref outside of refs/heads/ and
+    refs/tags/ (e.g. refs/changes/49/11249/1).
+
+    The tags are only narrowed down by a --match-tag pattern which is a
+    refspec pattern as well and if the revision doesn't name a tag
+    itself. Revisions which name such a ref without 'refs/' are fetched
+    separately (see other_ref()).
+    '''
+    refspecs = ['+refs/heads/*:refs/heads/*']
+
+    revision = revision or ''
+    tags     = 'refs/tags/*'
+    if not _needs_full_refspecs(args, revision):
+        tags = 'refs/tags/' + args.match_tag
+    refspecs.append('+%s:%s' % (tags, tags))
+
+    if revision.startswith('refs/') and \
+       not revision.startswith(('refs/heads/', 'refs/tags/')):
+        refspecs.append('+%s:%s' % (revision, revision))
+    return refspecs
+
+
+def other_ref(revision):
+    '''
+    Returns the full name of a ref outside of refs/heads/ and refs/tags/
+    which revision might name without 'refs/' (e.g. 'refs/pull/123/head'
+    for 'pull/123/head') or None. Whether it really is one is only known
+    once it turned out not to be a branch or tag.
+    '''
+    if not revision or '/' not in revision or \
+       revision.startswith(('refs/', '/')) or \
+       NO_REF_NAME.search(revision):
+        return None
+    return 'refs/' + revision
@@ -0,0 +1,357 @@
+'''
+This module contains the classes to read trees and blobs directly from
+the git object database without a working copy
+'''
+import logging
+import os
+import re
+import stat
+import subprocess
+
+# attributes which make a checked out file differ from its blob
+CONVERSION_ATTRIBUTES = re.compile(
+    br'(^|\s)-?(text|eol|crlf|filter|ident|working-tree-encoding)\b')
+
+# full object names are taken as they are, like 'git rev-parse --verify'
+# does, instead of being looked up
+FULL_SHA = re.compile(r'^([0-9a-f]{40}|[0-9a-f]{64})$')
+
+GIT_MODE_TREE    = 0o040000
+GIT_MODE_LINK    = 0o120000
+GIT_MODE_GITLINK = 0o160000
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def checkout_needed(args, partial_clone=False, in_osc=False):
+    """Returns the reason why a run with args can't build the archive from
+    the objects or None. Everything which needs files on disk or objects
+    which are not available locally requires a checkout."""
+    reasons = [(partial_clone, 'partial clone'),
+               (in_osc, 'running in osc'),
+               (args.package_meta, '--package-meta'),
+               (args.extract or args.extract_rename, '--extract'),
+               (args.use_obs_gbp, 'obs_gbp'),
+               (args.lfs == 'enable', '--lfs')]
+    for (needed, reason) in reasons:
+        if needed:
+            return reason
+    return None
+
+
+class GitObjectStore():
+    '''
+    Reads objects through a single long running 'git cat-file --batch'
+    process instead of starting one git process per object.
+    '''
+    def __init__(self, scmcmd, cwd):
+        self.scmcmd = scmcmd
+        self.cwd    = cwd
+        self.proc   = None
+
+    def _start(self):
+        logging.debug("COMMAND: %s", self.scmcmd + ['cat-file', '--batch'])
+        self.proc = subprocess.Popen(self.scmcmd + ['cat-file', '--batch'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     cwd=self.cwd)
+
+    def open(self, sha):
+        """Request the object sha. Returns (type, size) and leaves exactly
+        size bytes to be read from self.stdout, followed by a call to
+        self.done()."""
+        if self.proc is None:
+            self._start()
+        self.proc.stdin.write(sha.encode('ascii') + b'\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise SystemExit("git cat-file: object %s not found: %r" %
+                             (sha, b' '.join(header)))
+        return (header[1].decode('ascii'), int(header[2]))
+
+    @property
+    def stdout(self):
+        return self.proc.stdout
+
+    def done(self):
+        """Consume the newline terminating the current object."""
+        if self.proc.stdout.read(1) != b'\n':
+            raise SystemExit("git cat-file: unexpected output")
+
+    def read(self, sha):
+        """Returns the content of the object sha as bytes."""
+        (_, size) = self.open(sha)
+        data = self.proc.stdout.read(size)
+        self.done()
+        return data
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.proc = None
+
+
+class GitSession():
+    '''
+    Answers ref resolution and object lookups of one repository through
+    long running 'git cat-file --batch-check' and 'git cat-file --batch'
+    processes instead of spawning git for every query.
+
+    The processes must be restarted (close()) after operations which
+    change refs or objects, like fetch or reset.
+    '''
+    def __init__(self, scmcmd, cwd):
+        self.scmcmd = scmcmd
+        self.cwd    = cwd
+        self.check  = None
+        self.store  = GitObjectStore(scmcmd, cwd)
+
+    def _start(self):
+        cmd = self.scmcmd + ['cat-file', '--batch-check']
+        logging.debug("COMMAND: %s", cmd)
+        self.check = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, cwd=self.cwd)
+
+    def resolve(self, rev):
+        """Returns (sha, type) of the object rev refers to or None."""
+        if not rev or '\n' in rev:
+            return None
+        if self.check is None:
+            self._start()
+        self.check.stdin.write(os.fsencode(rev) + b'\n')
+        self.check.stdin.flush()
+        answer = self.check.stdout.readline().split()
+        # '<rev> missing' or '<rev> ambiguous'
+        if len(answer) != 3:
+            return None
+        return (answer[0].decode('ascii'), answer[1].decode('ascii'))
+
+    def rev_parse(self, rev):
+        """Returns the object name rev refers to or None, like
+        'git rev-parse --verify --quiet rev'."""
+        if FULL_SHA.match(rev or ''):
+            return rev
+        result = self.resolve(rev)
+        return result[0] if result else None
+
+    def commit(self, rev):
+        """Returns a dict with sha, tree, parents, author_time and
+        committer_time of the commit rev refers to or None."""
+        result = self.resolve(rev + '^{commit}')
+        if not result:
+            return None
+        info = {'sha': result[0], 'parents': []}
+        data = self.store.read(result[0])
+        for line in data.split(b'\n\n', 1)[0].split(b'\n'):
+            (key, _, value) = line.partition(b' ')
+            if key == b'tree':
+                info['tree'] = value.decode('ascii')
+            elif key == b'parent':
+                info['parents'].append(value.decode('ascii'))
+            elif key in (b'author', b'committer'):
+                # '<name> <email> <timestamp> <tz>'
+                timestamp = int(value.rsplit(b' ', 2)[1])
+                info[key.decode('ascii') + '_time'] = timestamp
+        return info
+
+    def close(self):
+        if self.check is not None:
+            self.check.stdin.close()
+            self.check.stdout.close()
+            self.check.wait()
+            self.check = None
+        self.store.close()
+
+
+class CommitLog():
+    '''
+    Parents and signature status of the commits reachable from a revision.
+
+    The parents are read from a single 'git log --topo-order' process as
+    far as commits are requested. Signatures are only checked on demand,
+    together with the next commits of the log, by one
+    'git log --no-walk --format=%G?' per batch, so older commits are not
+    checked without need. Results found in cache (see SignatureCache) are
+    not checked again, bad signatures are added to it. The commits which
+    have been reported as signed are collected in self.trusted.
+    '''
+    BATCH = 64
+
+    def __init__(self, scmcmd, cwd, rev, cache=None):
+        self.scmcmd     = scmcmd
+        self.cwd        = cwd
+        self.cache      = cache
+        self.commits    = {}
+        self.order      = []
+        self.signatures = {}
+        self.trusted    = set()
+        cmd = scmcmd + ['log', '--topo-order', '--format=%H %P', rev]
+        logging.debug("COMMAND: %s", cmd)
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, cwd=cwd)
+
+    def _read(self):
+        """Read the next commit of the log. Returns False at its end."""
+        if self.proc is None:
+            return False
+        line = self.proc.stdout.readline()
+        if not line:
+            self.close()
+            return False
+        fields = line.decode('ascii').split()
+        self.commits[fields[0]] = (len(self.order), fields[1:])
+        self.order.append(fields[0])
+        return True
+
+    def parents(self, sha):
+        while sha not in self.commits and self._read():
+            pass
+        if sha not in self.commits:
+            raise SystemExit("%s: No such commit" % sha)
+        return self.commits[sha][1]
+
+    def signed(self, sha):
+        """Returns True if git considers the signature of sha good, like
+        'git verify-commit' does."""
+        if sha not in self.signatures:
+            self._check(sha)
+        if not self.signatures[sha]:
+            return False
+        self.trusted.add(sha)
+        return True
+
+    def _check(self, sha):
+        if self.cache and self.cache.get('commit', sha) is not None:
+            self.signatures[sha] = self.cache.get('commit', sha)
+            return
+
+        self.parents(sha)
+        pos = self.commits[sha][0]
+        while len(self.order) < pos + self.BATCH and self._read():
+            pass
+        batch = [sha]
+        for other in self.order[pos + 1:pos + self.BATCH]:
+            if other in self.signatures:
+                continue
+            if self.cache and self.cache.get('commit', other) is not None:
+                self.signatures[other] = self.cache.get('commit', other)
+                continue
+            batch.append(other)
+
+        cmd = self.scmcmd + ['log', '--no-walk=unsorted',
+                             '--no-show-signature', '--format=%H %G?']
+        logging.debug("COMMAND: %s", cmd + ['(%d commits)' % len(batch)])
+        proc = subprocess.Popen(cmd + batch, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, cwd=self.cwd)
+        output = proc.communicate()[0]
+        if proc.returncode:
+            raise SystemExit("Command %s failed(%d)" %
+                             (cmd, proc.returncode))
+        for line in output.decode('ascii').splitlines():
+            (commit, status) = line.split(' ')
+            self.signatures[commit] = status in ('G', 'U')
+            # only 'git verify-commit' may add good signatures to the cache
+            if self.cache and not self.signatures[commit]:
+                self.cache.set('commit', commit, False)
+
+    def reject(self, sha):
+        """Mark the signature of sha as bad."""
+        self.signatures[sha] = False
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.proc.stdout.close()
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+        self.proc = None
+
+
+class GitTree():
+    '''
+    The recursive listing of the tree of a commit, which allows to build
+    archives straight from the object database.
+
+    Modes are the ones a checkout would create with the current umask.
+    '''
+    def __init__(self, scmcmd, cwd, rev):
+        self.rev     = rev
+        self.store   = GitObjectStore(scmcmd, cwd)
+        self.entries = {}
+        self.umask   = _umask()
+
+        cmd = scmcmd + ['ls-tree', '-r', '-t', '-z', '--full-tree', rev]
+        logging.debug("COMMAND: %s", cmd)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=cwd)
+        (output, err) = proc.communicate()
+        if proc.returncode:
+            raise SystemExit("Command %s failed(%d): '%s'" %
+                             (cmd, proc.returncode, err.decode('UTF-8')))
+        for record in output.split(b'\0'):
+            if not record:
+                continue
+            (info, path) = record.split(b'\t', 1)
+            (mode, _, sha) = info.split(b' ')
+            self.entries[os.fsdecode(path)] = (int(mode, 8),
+                                               sha.decode('ascii'))
+
+    def needs_checkout(self, submodules, subdir=''):
+        """Returns the reason why the archive of subdir can't be built from
+        the objects or None."""
+        if not self.is_dir(subdir):
+            # e.g. a symlink, let the checkout sort it out
+            return "'%s' is no directory" % subdir
+        if submodules and '.gitmodules' in self.entries:
+            return "submodules are enabled"
+        for (path, (mode, sha)) in self.entries.items():
+            if os.path.basename(path) != '.gitattributes':
+                continue
+            if mode in (GIT_MODE_TREE, GIT_MODE_LINK, GIT_MODE_GITLINK):
+                continue
+            if CONVERSION_ATTRIBUTES.search(self.store.read(sha)):
+                return "'%s' defines content conversions" % path
+        return None
+
+    def is_dir(self, path):
+        return path in ('', os.curdir) or \
+            self.entries.get(path, (0, None))[0] == GIT_MODE_TREE
+
+    def mode(self, git_mode):
+        """Returns the file mode a checkout creates for git_mode."""
+        umask = self.umask
+        if git_mode in (GIT_MODE_TREE, GIT_MODE_GITLINK):
+            return stat.S_IFDIR | (0o777 & ~umask)
+        if git_mode == GIT_MODE_LINK:
+            return stat.S_IFLNK | 0o777
+        if git_mode & 0o111:
+            return stat.S_IFREG | (0o777 & ~umask)
+        return stat.S_IFREG | (0o666 & ~umask)
+
+    def walk(self, subdir, ffilter):
+        """Returns the sorted list of (path, mode, sha) below subdir which
+        match ffilter. The paths are relative to ffilter.topdir, just like
+        if subdir had been copied to topdir."""
+        prefix = ''
+        if subdir not in ('', os.curdir):
+            prefix = subdir + '/'
+        result = []
+        for (path, (git_mode, sha)) in self.entries.items():
+            if not path.startswith(prefix):
+                continue
+            name = os.path.join(ffilter.topdir, path[len(prefix):])
+            if ffilter.match(name):
+                result.append((name, self.mode(git_mode), sha))
+        return sorted(result)
+
+    def close(self):
+        self.store.close()
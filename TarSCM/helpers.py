@@ -1,9 +1,11 @@
 from __future__ import print_function
 
 import datetime
+import errno
 import os
 import logging
 import subprocess
+import tempfile
 import io
 
 # python3 renaming of StringIO
@@ -24,6 +26,156 @@ def file_write_legacy(fname, string, *args):
         outfile.write(str(string).encode('UTF-8').decode('UTF-8'))
 
 
+# below this size the syscalls cost more than copying through the buffer
+KERNEL_COPY_MIN = 64 * 1024
+
+
+def _fileno(fileobj):
+    try:
+        return fileobj.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+
+
+def _copy_range(src_fd, dst_fd, offset, dst_offset, count):
+    """Copy count bytes inside the kernel. Returns the number of bytes
+    copied, which is short if neither syscall is usable."""
+    copied = 0
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < count:
+                if method == 'copy_file_range':
+                    ret = os.copy_file_range(src_fd, dst_fd, count - copied,
+                                             offset + copied,
+                                             dst_offset + copied)
+                else:
+                    os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+                    ret = os.sendfile(dst_fd, src_fd, offset + copied,
+                                      count - copied)
+                if not ret:
+                    break
+                copied += ret
+            return copied
+        except OSError:
+            # e.g. EXDEV/EINVAL/ENOSYS: try the next method
+            continue
+    return copied
+
+
+def copy_file_data(src, dst, size, bufsize=1024 * 1024):
+    """Copy size bytes from the current position of src to dst.
+
+    If src is an unbuffered file (io.FileIO), dst is backed by a regular
+    file and there are at least KERNEL_COPY_MIN bytes to copy, the data
+    is transferred from fd to fd without passing through python with
+    os.copy_file_range()/os.sendfile(). Everything else, and whatever
+    these syscalls refuse to copy, is copied through a buffer. Returns
+    the number of bytes copied.
+    """
+    copied = 0
+    src_fd = None
+    dst_fd = None
+    if size >= KERNEL_COPY_MIN and isinstance(src, io.FileIO):
+        src_fd = _fileno(src)
+        dst_fd = _fileno(dst)
+    if src_fd is not None and dst_fd is not None:
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        try:
+            offset = src.tell()
+            dst.flush()
+            dst_offset = dst.tell()
+        except (OSError, io.UnsupportedOperation):
+            offset = None
+        if offset is not None:
+            copied = _copy_range(src_fd, dst_fd, offset, dst_offset, size)
+            if copied:
+                src.seek(offset + copied)
+                dst.seek(dst_offset + copied)
+
+    while copied < size:
+        chunk = src.read(min(bufsize, size - copied))
+        if not chunk:
+            break
+        dst.write(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def data_segments(src_fd, size):
+    """Returns the data regions of the first size bytes of a file as list
+    of (offset, length), which leaves out the holes of sparse files.
+    Returns None if the filesystem can't tell. The file position is not
+    changed.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    segments = []
+    offset = 0
+    position = os.lseek(src_fd, 0, os.SEEK_CUR)
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(src_fd, offset, os.SEEK_DATA)
+            except OSError as exc:
+                # the rest of the file is a hole
+                if exc.errno == errno.ENXIO:
+                    break
+                raise
+            if start >= size:
+                break
+            end = min(os.lseek(src_fd, start, os.SEEK_HOLE), size)
+            segments.append((start, end - start))
+            offset = end
+    except OSError:
+        return None
+    finally:
+        os.lseek(src_fd, position, os.SEEK_SET)
+    return segments
+
+
+def write_zeros(dst, count, bufsize=1024 * 1024):
+    """Write count zero bytes to dst. Seekable files just skip them, which
+    leaves a hole if nothing gets written there afterwards."""
+    if not count:
+        return
+    if _fileno(dst) is not None and dst.seekable():
+        dst.seek(count, os.SEEK_CUR)
+        return
+    zeros = memoryview(bytes(min(bufsize, count)))
+    while count:
+        chunk = min(count, len(zeros))
+        dst.write(zeros[:chunk])
+        count -= chunk
+
+
+def copy_sparse_data(src, dst, size, bufsize=1024 * 1024, segments=None):
+    """Like copy_file_data(), but the holes of a sparse src are not read
+    and only written as zeros. The result is the same as with a plain
+    copy."""
+    src_fd = _fileno(src) if isinstance(src, io.FileIO) else None
+    if segments is None and src_fd is not None:
+        segments = data_segments(src_fd, size)
+    if segments is None or segments == [(0, size)]:
+        return copy_file_data(src, dst, size, bufsize)
+
+    copied = 0
+    for (start, length) in segments:
+        write_zeros(dst, start - copied, bufsize)
+        src.seek(start)
+        done = copy_file_data(src, dst, length, bufsize)
+        copied = start + done
+        if done != length:
+            return copied
+    write_zeros(dst, size - copied, bufsize)
+    return size
+
+
 class Helpers():
     def run_cmd(self, cmd, cwd, interactive=False, raisesysexit=False):
         """
@@ -72,6 +224,39 @@ class Helpers():
         result = self.run_cmd(cmd, cwd, interactive, raisesysexit=True)
         return result
 
+    def stream_cmd(self, cmd, cwd):
+        """
+        Generator which yields the output lines of the command cmd while it
+        is running. If the generator is closed before all lines have been
+        read, the command is terminated. If the command returns non-zero
+        raise a SystemExit exception like safe_run() does.
+        """
+        logging.debug("COMMAND: %s" % cmd)
+
+        with tempfile.TemporaryFile() as errors:
+            proc = subprocess.Popen(cmd,
+                                    shell=False,
+                                    stdout=subprocess.PIPE,
+                                    stderr=errors,
+                                    cwd=cwd)
+            try:
+                for line in proc.stdout:
+                    yield line.rstrip(b'\n').decode('UTF-8')
+            finally:
+                proc.stdout.close()
+                if proc.poll() is None:
+                    proc.terminate()
+                proc.wait()
+
+            if proc.returncode:
+                errors.seek(0)
+                output = errors.read().decode('UTF-8')
+                logging.info("ERROR(%d): %s", proc.returncode, repr(output))
+                raise SystemExit(
+                    "Command %s failed(%d): '%s'" % (cmd, proc.returncode,
+                                                     output)
+                )
+
     def get_timestamp(self, scm_object, args, clone_dir):
         """Returns the commit timestamp for checked-out repository."""
 
@@ -0,0 +1,75 @@
+'''
+This module contains the class CacheLock
+'''
+import errno
+import fcntl
+import logging
+import os
+
+
+class CacheLock():
+    '''
+    flock(2) based lock of a repository cache.
+
+    Fetching into the cache needs an exclusive lock. Runs which only read
+    from the cache (creating a working copy, building the archive from
+    objects the working copy borrows from the cache) share the lock. The
+    lock is released as soon as the archive only needs a copy of the
+    sources, so only runs building it from the objects of the cache keep
+    fetching runs waiting while the archive is written.
+
+    The lock belongs to the open file, so the kernel releases it as soon
+    as the holding process is gone and there are no stale locks. The lock
+    file is never removed, because other runs might already wait on it,
+    and only contains the PID of the last exclusive holder for diagnosis.
+    '''
+    def __init__(self, path):
+        self.path      = path
+        self.fdesc     = None
+        self.exclusive = None
+
+    def acquire(self, exclusive=True):
+        '''
+        Wait for the lock, or convert the lock which is already held. Like
+        flock(2) a conversion is not atomic, another run might get the
+        lock in between.
+        '''
+        if self.fdesc is not None and self.exclusive == exclusive:
+            return
+        if self.fdesc is None:
+            self.fdesc = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        mode = 'exclusive' if exclusive else 'shared'
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(self.fdesc, operation | fcntl.LOCK_NB)
+        except (IOError, OSError) as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            logging.info("Waiting for %s lock on '%s' (last holder: %s)",
+                         mode, self.path, self.holder())
+            fcntl.flock(self.fdesc, operation)
+        self.exclusive = exclusive
+
+        if exclusive:
+            os.ftruncate(self.fdesc, 0)
+            os.lseek(self.fdesc, 0, os.SEEK_SET)
+            os.write(self.fdesc, ('%d\n' % os.getpid()).encode('ascii'))
+        logging.debug("Holding %s lock on '%s'", mode, self.path)
+
+    def release(self):
+        '''Release the lock if it is held.'''
+        if self.fdesc is None:
+            return
+        logging.debug("Unlocking cache: %s", self.path)
+        fcntl.flock(self.fdesc, fcntl.LOCK_UN)
+        os.close(self.fdesc)
+        self.fdesc     = None
+        self.exclusive = None
+
+    def holder(self):
+        '''Returns the PID of the last exclusive holder or 'unknown'.'''
+        try:
+            with open(self.path) as lfh:
+                return lfh.read().strip() or 'unknown'
+        except (IOError, OSError):
+            return 'unknown'
@@ -0,0 +1,128 @@
+'''
+This module contains the class Materializer
+'''
+import errno
+import logging
+import os
+import shutil
+import stat
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request number of FICLONE (_IOW(0x94, 9, int)) on linux
+FICLONE = 0x40049409
+
+# errors which mean that a method is not usable between two files at all
+# (filesystem without reflink support, different devices, ...) instead
+# of being a problem of a single file
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL,
+               errno.ENOTTY, errno.ENOSYS, errno.EPERM, errno.EMLINK)
+
+
+def reflink(src, dst):
+    """Create dst as a reflink of src, sharing its data blocks."""
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks are not supported")
+    with open(src, 'rb') as fsrc:
+        try:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+class Materializer():
+    '''
+    Creates copies of files and directory trees as cheaply as the
+    filesystem allows.
+
+    Files are reflinked (btrfs, xfs, ...) if possible. The copy then
+    shares the data blocks with its source but is an independent file.
+    If hardlink is True, files may alternatively be hardlinked, which is
+    only safe if neither the source nor the copy are modified afterwards.
+    Everything else is copied by a pool of threads, as copying releases
+    the GIL. A method which fails for reasons which are not specific to
+    a single file is not tried again.
+    '''
+    def __init__(self, hardlink=False, workers=None):
+        self.hardlink    = hardlink
+        self.use_reflink = fcntl is not None
+        self.workers     = workers or min(32, 4 * (os.cpu_count() or 1))
+
+    def copy_file(self, src, dst, hardlink=None):
+        """Copy the file src to dst like shutil.copy2(). Returns the method
+        which was used."""
+        if hardlink is None:
+            hardlink = self.hardlink
+
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        if os.path.lexists(dst):
+            os.unlink(dst)
+
+        if self.use_reflink:
+            try:
+                reflink(src, dst)
+                return 'reflink'
+            except (IOError, OSError) as exc:
+                if exc.errno not in UNSUPPORTED:
+                    raise
+                logging.debug("Disabling reflinks: %s", exc)
+                self.use_reflink = False
+
+        if hardlink:
+            try:
+                os.link(src, dst)
+                return 'hardlink'
+            except OSError as exc:
+                if exc.errno not in UNSUPPORTED:
+                    raise
+                if exc.errno != errno.EMLINK:
+                    logging.debug("Disabling hardlinks: %s", exc)
+                    self.hardlink = hardlink = False
+
+        shutil.copy2(src, dst)
+        return 'copy'
+
+    def copy_tree(self, src, dst):
+        """Recursively copy the directory src to dst, which must not exist.
+
+        Symlinks are copied as symlinks, like
+        shutil.copytree(src, dst, symlinks=True) does.
+        """
+        dirs  = []
+        files = []
+        self._create_dirs(src, dst, dirs, files)
+
+        if files:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for _ in executor.map(lambda f: self.copy_file(*f), files):
+                    pass
+
+        # entries in a directory change its mtime, so the directory
+        # stats have to be copied after everything else, deepest first
+        for (s_dir, d_dir) in reversed(dirs):
+            shutil.copystat(s_dir, d_dir)
+
+    def _create_dirs(self, src, dst, dirs, files):
+        os.makedirs(dst)
+        dirs.append((src, dst))
+        for entry in sorted(os.scandir(src), key=lambda e: e.name):
+            s_path = entry.path
+            d_path = os.path.join(dst, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(s_path), d_path)
+                shutil.copystat(s_path, d_path, follow_symlinks=False)
+            elif entry.is_dir():
+                self._create_dirs(s_path, d_path, dirs, files)
+            elif stat.S_ISREG(entry.stat(follow_symlinks=False).st_mode):
+                files.append((s_path, d_path))
+            else:
+                shutil.copy2(s_path, d_path)
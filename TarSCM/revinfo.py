@@ -0,0 +1,162 @@
+'''
+This module contains the class RevisionInfo
+'''
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from TarSCM.gitmirror import is_shallow
+from TarSCM.helpers import Helpers
+
+
+class RevisionInfo():
+    '''
+    Metadata of a single commit (commit time, parent tag, tag offsets and
+    formatted versions), which is determined at most once per commit.
+
+    The git commands run with the base command and in the repository of
+    the GitSession they are looked up with. Everything but the formatted
+    versions is also remembered in memo_dir for later runs. The parent
+    tag and the tag offsets depend on the tags of the repository, so they
+    are only reused as long as the tags did not change.
+    '''
+    # (repository, commit, --match-tag) => RevisionInfo
+    _known = {}
+
+    def __init__(self, session, sha, memo_dir=None, match_tag=None):
+        self.session   = session
+        self.sha       = sha
+        self.match_tag = match_tag
+        self.data      = {}
+        self.formats   = {}
+        self.tags      = None
+        self.memo      = None
+        if memo_dir:
+            name = sha
+            if match_tag:
+                digest = hashlib.sha256(match_tag.encode('UTF-8'))
+                name += '-' + digest.hexdigest()[:16]
+            self.memo = os.path.join(memo_dir, name + '.json')
+            self._load()
+
+    @classmethod
+    def lookup(cls, session, rev, memo_dir=None, match_tag=None):
+        """Returns the RevisionInfo of the commit rev refers to or None."""
+        sha = session.rev_parse(rev + '^{commit}')
+        if not sha:
+            return None
+        key = (session.cwd, sha, match_tag)
+        if key not in cls._known:
+            cls._known[key] = cls(session, sha, memo_dir, match_tag)
+        info = cls._known[key]
+        if info.session is not session:
+            info.reset(session)
+        return info
+
+    def reset(self, session):
+        """Forget everything which might have changed since the last
+        session, because refs have changed in the meantime or other runs
+        updated the memo."""
+        self.session = session
+        self.formats = {}
+        self.tags    = None
+        if self.memo:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.memo) as memo:
+                self.data = json.load(memo)
+        except (IOError, OSError, ValueError):
+            self.data = {}
+
+    def _save(self):
+        if not self.memo:
+            return
+        memodir = os.path.dirname(self.memo)
+        try:
+            if not os.path.isdir(memodir):
+                os.makedirs(memodir)
+            (fdesc, tmpname) = tempfile.mkstemp(prefix='.tmp-', dir=memodir)
+            with os.fdopen(fdesc, 'w') as memo:
+                json.dump(self.data, memo, sort_keys=True)
+            os.rename(tmpname, self.memo)
+        except (IOError, OSError) as exc:
+            logging.debug("Could not write '%s': %s", self.memo, exc)
+
+    def _run(self, args):
+        return Helpers().run_cmd(self.session.scmcmd + args, self.session.cwd)
+
+    def _tags_fingerprint(self):
+        """Returns a hash over all tags of the repository."""
+        if self.tags is None:
+            output = Helpers().safe_run(
+                self.session.scmcmd + ['for-each-ref',
+                                       '--format=%(objectname) %(refname)',
+                                       'refs/tags'],
+                self.session.cwd)[1]
+            # tags which are not part of a shallow history aren't found
+            if is_shallow(self.session.cwd):
+                output += 'shallow\n'
+            self.tags = hashlib.sha256(output.encode('UTF-8')).hexdigest()
+        return self.tags
+
+    def _tag_data(self):
+        """Returns the data which depends on the tags. It is dropped if the
+        tags have changed since it was determined."""
+        tags = self._tags_fingerprint()
+        if self.data.get('tags') != tags:
+            self.data['tags']        = tags
+            self.data['parent_tag']  = None
+            self.data['tag_offsets'] = {}
+        return self.data
+
+    def commit_time(self):
+        if 'commit_time' not in self.data:
+            commit = self.session.commit(self.sha)
+            self.data['commit_time'] = commit['committer_time']
+            self._save()
+        return self.data['commit_time']
+
+    def parent_tag(self):
+        """Returns the latest tag reachable from the commit (matching
+        --match-tag) or ''."""
+        data = self._tag_data()
+        if data['parent_tag'] is None:
+            cmd = ['describe', '--tags', '--abbrev=0']
+            if self.match_tag:
+                cmd.append("--match=%s" % self.match_tag)
+            cmd.append(self.sha)
+            rcode, output = self._run(cmd)
+            # strip to remove newlines
+            data['parent_tag'] = output.strip() if rcode == 0 else ''
+            self._save()
+        return data['parent_tag']
+
+    def tag_offset(self, parent_tag):
+        """Returns the number of commits since parent_tag as string."""
+        data = self._tag_data()
+        if parent_tag not in data['tag_offsets']:
+            rcode, out = self._run(['rev-list', '--count',
+                                    parent_tag + '..' + self.sha])
+
+            if rcode:
+                msg = "\033[31m@TAG_OFFSET@ can not be expanded: {}\033[0m"
+                msg = msg.format(out)
+                sys.exit(msg)
+
+            data['tag_offsets'][parent_tag] = out.strip()
+            self._save()
+        return data['tag_offsets'][parent_tag]
+
+    def format(self, log_cmd):
+        """Returns the output of log_cmd, a 'git log -n1' for this commit
+        which only differs in the requested format."""
+        key = ' '.join(log_cmd)
+        if key not in self.formats:
+            self.formats[key] = Helpers().safe_run(log_cmd,
+                                                   self.session.cwd)[1]
+        return self.formats[key]
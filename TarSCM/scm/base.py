@@ -4,14 +4,18 @@ import sys
 import logging
 import re
 import hashlib
+import json
 import shutil
 import time
 import subprocess
 import glob
 
 from TarSCM.helpers import Helpers
+from TarSCM.materialize import Materializer
+from TarSCM.archive import sparse_checkout_patterns
 from TarSCM.changes import Changes
 from TarSCM.config import Config
+from TarSCM.locking import CacheLock
 
 try:
     from urllib.parse import urlparse
@@ -25,25 +29,40 @@ try:
 except ImportError:
     KEYRING_IMPORT_ERROR = 1
 
+# repocachedir suffixes, which keep partial clones apart from the mirrors
+PARTIAL_CLONE_SUFFIX = {
+    'tree:0':    '-pc',
+    'blob:none': '-pc-blob',
+}
+
 
 class Scm():
 
     scm = None
+    # whether the working copy is created apart from the repository cache
+    # (see prepare_working_copy()), so it only reads from the cache
+    separate_working_copy = False
     partial_clone = False
+    clone_filter = 'tree:0'
+    sparse_checkout = None
 
     def __init__(self, args, task):
         # default settings
         # arch_dir - Directory which is used for the archive
         # e.g. myproject-2.0
         self.arch_dir          = None
+        self.cachedir          = None
         self.repocachedir      = None
         self.clone_dir         = None
-        self.lock_file         = None
+        self.cache_lock        = None
         self.basename          = None
         self.repodir           = None
         self.user              = None
         self.password          = None
         self._parent_tag       = None
+        # tree to build the archive from without a working copy
+        # (see GitTree)
+        self.object_tree       = None
         self._backup_gnupghome = None
         # proxy support
         self.httpproxy         = None
@@ -143,19 +162,34 @@ class Scm():
         self._calc_dir_to_clone_to(clone_prefix)
         self.prepare_clone_dir()
 
-        self.lock_cache()
+        # runs which don't fetch only read from the cache and can share it
+        # if the working copy is separate from the cache
+        shared = self.separate_working_copy
+        self.lock_cache(exclusive=not shared)
 
-        if not os.path.isdir(self.clone_dir):
-            # initial clone
-            logging.debug(
-                "[fetch_upstream] Initial checkout/clone to directory: '%s'",
-                self.clone_dir
-            )
-            os.mkdir(self.clone_dir)
-            self.fetch_upstream_scm()
+        if shared and os.path.isdir(self.clone_dir) and \
+           self._cache_is_fresh():
+            logging.info("Using cached repository without fetching...")
         else:
-            logging.info("Detected cached repository...")
-            self.update_cache()
+            self.lock_cache()
+            # another run might have fetched while waiting for the lock
+            if not os.path.isdir(self.clone_dir):
+                # initial clone
+                logging.debug(
+                    "[fetch_upstream] Initial checkout/clone to directory: "
+                    "'%s'", self.clone_dir
+                )
+                os.mkdir(self.clone_dir)
+                self.fetch_upstream_scm()
+                self._record_fetch()
+            elif self._cache_is_fresh():
+                logging.info("Using cached repository without fetching...")
+            else:
+                logging.info("Detected cached repository...")
+                self.update_cache()
+                self._record_fetch()
+            if shared:
+                self.lock_cache(exclusive=False)
 
         self.prepare_working_copy()
 
@@ -173,7 +207,67 @@ class Scm():
         if self.args.use_obs_scm:
             self.fetch_lfs()
 
-        self.unlock_cache()
+    def _fetch_stamp(self):
+        return os.path.join(self.repocachedir, '.fetched')
+
+    def _fetch_ttl(self):
+        """Returns CACHE_FETCH_TTL from the environment or the config in
+        seconds or 0 if it is not set."""
+        ttl = os.getenv('CACHE_FETCH_TTL')
+        if ttl is None:
+            ttl = Config().get('tar_scm', 'CACHE_FETCH_TTL')
+        try:
+            return max(int(ttl or 0), 0)
+        except ValueError:
+            logging.warning("Ignoring invalid CACHE_FETCH_TTL '%s'", ttl)
+            return 0
+
+    def _cache_is_fresh(self):
+        """Returns True if fetching can be skipped, because the requested
+        revision can't change upstream anymore and is already cached or
+        because the same fetch has been done less than CACHE_FETCH_TTL
+        seconds ago (e.g. by the service of another package)."""
+        if not self.repocachedir:
+            return False
+        if self._revision_present():
+            logging.debug("Revision '%s' is already cached", self.revision)
+            return True
+
+        ttl = self._fetch_ttl()
+        if not ttl:
+            return False
+        try:
+            with open(self._fetch_stamp()) as stamp:
+                data = json.load(stamp)
+        except (IOError, OSError, ValueError):
+            return False
+        if data.get('fetch') != self._fetch_signature():
+            return False
+        age = time.time() - data.get('time', 0)
+        logging.debug("Cache has been fetched %d seconds ago", age)
+        return 0 <= age < ttl
+
+    def _record_fetch(self):
+        """Remember when and what has been fetched into the cache for
+        _cache_is_fresh()."""
+        if not self.repocachedir:
+            return
+        data = {'time': time.time(), 'fetch': self._fetch_signature()}
+        (fdesc, tmpname) = tempfile.mkstemp(prefix='.tmp-',
+                                            dir=self.repocachedir)
+        with os.fdopen(fdesc, 'w') as stamp:
+            json.dump(data, stamp)
+        os.rename(tmpname, self._fetch_stamp())
+
+    def _fetch_signature(self):
+        """Returns what update_cache() fetches. The svn and bzr caches are
+        working copies, which update_cache() updates to the revision."""
+        return self.revision or ''
+
+    def _revision_present(self):
+        """Returns True if the requested revision is immutable (e.g. a
+        commit id) and already in the cache."""
+        return False
 
     def fetch_submodules(self):
         """NOOP in other scm's than git"""
@@ -214,6 +308,11 @@ class Scm():
     def get_current_commit(self):
         return None
 
+    def remote_revision(self):
+        """Returns the commit the requested revision currently refers to
+        upstream without fetching it or None if that is not possible."""
+        return None
+
     def _calc_repocachedir(self):
         # check for enabled caches in this order (first wins):
         #   1. local .cache
@@ -233,6 +332,7 @@ class Scm():
 
         if repocachedir:
             logging.debug("REPOCACHE: %s", repocachedir)
+            self.cachedir = repocachedir
             self.repohash = self.get_repocache_hash()
             self.repocachedir = os.path.join(repocachedir, self.repohash)
 
@@ -291,11 +391,16 @@ class Scm():
         osc_version = 0
 
         logging.debug(" - SUBDIR: %s", self.args.subdir)
-        if not self.args.subdir and self.scm == 'git' and not self.in_osc:
+        self.sparse_checkout = self._sparse_checkout_args()
+        clone_filter = self._choose_clone_filter()
+        if clone_filter:
             self.partial_clone = True
-            logging.debug("NO SUBDIR FOUND - USING PARTIAL CLONE")
+            self.clone_filter  = clone_filter
+            logging.debug("USING PARTIAL CLONE: --filter=%s, sparse: %s",
+                          clone_filter, self.sparse_checkout)
             if self.repocachedir:
-                self.repocachedir = self.repocachedir + '-pc'
+                self.repocachedir = self.repocachedir + \
+                    PARTIAL_CLONE_SUFFIX[clone_filter]
 
         try:
             osc_version = os.environ['OSC_VERSION']
@@ -322,6 +427,54 @@ class Scm():
 
         logging.debug("[_calc_dir_to_clone_to] CLONE_DIR: %s", self.clone_dir)
 
+    def _choose_clone_filter(self):
+        """Returns the --filter for a partial clone or None if the run needs
+        a full clone."""
+        args = self.args
+        if self.sparse_checkout:
+            # only the trees are needed to check out a part of the tree,
+            # blobs outside of it are neither downloaded nor written
+            return 'blob:none'
+        if self.scm != 'git' or self.in_osc or args.subdir:
+            return None
+        # the packed metadata must not depend on the cache or upstream and
+        # streaming reads the blobs from the local object database
+        if getattr(args, 'package_meta', False) or \
+           getattr(args, 'stream_objects', False):
+            return None
+        # an existing mirror is cheaper to update than a new partial clone
+        if self.repocachedir and \
+           os.path.isdir(os.path.join(self.repocachedir, self.basename)):
+            logging.debug("Using the existing mirror of the repository")
+            return None
+        # versions, tag offsets and changes only need the commits and the
+        # trees of the checkout are prefetched in one go (see
+        # Git._prefetch_objects())
+        return 'tree:0'
+
+    def _sparse_checkout_args(self):
+        """Returns the arguments for 'git sparse-checkout set' which restrict
+        the working copy to what gets packed or None if the whole tree is
+        needed."""
+        args = self.args
+        if self.scm != 'git' or self.in_osc:
+            return None
+        # the GBP service works on the whole clone_dir and streaming
+        # reads the blobs from the object database instead of a checkout
+        if getattr(args, 'use_obs_gbp', False) or \
+           getattr(args, 'stream_objects', False):
+            return None
+        # --extract is not limited by --include/--exclude
+        extracts = [getattr(args, 'extract', None),
+                    getattr(args, 'extract_rename', None)]
+        if not any(extracts):
+            patterns = sparse_checkout_patterns(args)
+            if patterns:
+                return ['--no-cone'] + patterns
+        if args.subdir and args.subdir != os.curdir:
+            return ['--cone', args.subdir]
+        return None
+
     def is_sslverify_enabled(self):
         """Returns ``True`` if the ``sslverify`` option has been enabled or
         not been set (default enabled) ``False`` otherwise."""
@@ -350,6 +503,11 @@ class Scm():
         """Prepare directory tree for creation of the archive by copying the
         requested sub-directory to the top-level destination directory.
         """
+        if self.object_tree:
+            # the archive gets built from the objects, nothing to copy
+            self.arch_dir = os.path.join(outdir, dstname)
+            return
+
         src = os.path.join(self.clone_dir, subdir)
         if not os.path.exists(src):
             raise Exception("%s: No such file or directory" % src)
@@ -368,37 +526,52 @@ class Scm():
 
         logging.debug("copying tree: '%s' to '%s'", src, dst)
 
-        shutil.copytree(src, dst, symlinks=True)
-
-    def lock_cache(self):
-        pdir = os.path.join(self.clone_dir, os.pardir, '.lock')
-        if os.path.isfile(pdir):
-            mtime = os.path.getmtime(pdir)
-            if mtime < time.time() - 86400:
-                logging.error(" Lock older than 24h")
-                logging.error(" Please check if another process is currently"
-                              " running.")
-                logging.error(" Stale lock must be removed manually: '%s'"
-                              % pdir)
-                raise SystemExit(1)
-        while True:
-            if os.path.isfile(pdir):
-                time.sleep(0.1)
-            else:
-                logging.debug("Using lockfile: %s", pdir)
-                self.lock_file = open(os.path.abspath(pdir), 'w')
-                break
-
-    def unlock_cache(self):
-        if self.lock_file and os.path.isfile(self.lock_file.name):
-            logging.debug("Unlocking cache: %s", self.lock_file.name)
-            try:
-                self.lock_file.close()
-                os.unlink(self.lock_file.name)
-            except:
-                pass
+        # hardlinks are only safe if the clone is a private temporary
+        # copy, otherwise the cached working copy could be modified
+        # through the archive directory
+        engine = Materializer(hardlink=self._is_private_clone())
+        engine.copy_tree(src, dst)
+
+    def _is_private_clone(self):
+        """Returns True if clone_dir gets removed at the end of the run."""
+        if not self.task or self.args.skip_cleanup:
+            return False
+        c_dir = os.path.realpath(self.clone_dir)
+        for tmp in self.task.cleanup_dirs:
+            tmp = os.path.realpath(tmp)
+            if c_dir == tmp or c_dir.startswith(tmp + os.sep):
+                return True
+        return False
+
+    def lock_cache(self, exclusive=True):
+        """Lock the repository cache, exclusively for fetching into it and
+        shared for only reading from it (see CacheLock). A lock which is
+        already held is converted. The lock is held until the archive only
+        needs the copy in arch_dir (see unlock_cache())."""
+        if not self.repocachedir:
+            return
+        if not self.cache_lock:
+            self.cache_lock = CacheLock(os.path.join(self.repocachedir,
+                                                     '.lock'))
+        self.cache_lock.acquire(exclusive)
+
+    def unlock_cache(self, arch_only=False):
+        """Unlock the repository cache. arch_only tells that the caller
+        only reads from arch_dir from now on, then the cache stays locked
+        if the archive still needs it: if arch_dir isn't a copy or the
+        archive is built from the objects of the cache."""
+        if arch_only and (self.object_tree or not self._arch_dir_copied()):
+            return
+        if self.cache_lock:
+            self.cache_lock.release()
 
-            self.lock_file = None
+    def _arch_dir_copied(self):
+        """Returns True if arch_dir is a copy outside of clone_dir."""
+        if not self.arch_dir:
+            return False
+        a_dir = os.path.realpath(self.arch_dir)
+        c_dir = os.path.realpath(self.clone_dir)
+        return a_dir != c_dir and not a_dir.startswith(c_dir + os.sep)
 
     def finalize(self):
         self.cleanup()
@@ -419,15 +592,63 @@ class Scm():
     def _prepare_gpg_settings(self):
         logging.debug("preparing gpg settings")
         self._backup_gnupghome = os.getenv('GNUPGHOME')
-        gpgdir = tempfile.mkdtemp()
-        mode = int('700', 8)
-        os.chmod(gpgdir, mode)
+        if self.cachedir:
+            gpgdir = self._cached_gnupghome()
+        else:
+            gpgdir = tempfile.mkdtemp()
+            mode = int('700', 8)
+            os.chmod(gpgdir, mode)
+            self._import_keys(gpgdir)
         os.putenv('GNUPGHOME', gpgdir)
-        logging.debug("Importing file '%s' to gnupghome: '%s'.")
+
+    def _import_keys(self, gpgdir):
+        logging.debug("Importing file '%s' to gnupghome: '%s'.",
+                      self.args.maintainers_asc, gpgdir)
         self.helpers.safe_run(
-            ['gpg', '--import', self.args.maintainers_asc],
+            ['gpg', '--homedir', gpgdir, '--import',
+             self.args.maintainers_asc],
             cwd=self.clone_dir, interactive=sys.stdout.isatty())
 
+    def _cached_gnupghome(self):
+        """
+        Returns a gpg home directory in the cache which contains the keys of
+        --maintainers-asc. It is created once per content of the file and
+        only read afterwards, so concurrent runs can share it. A changed
+        file results in a new directory.
+        """
+        with open(self.args.maintainers_asc, 'rb') as asc:
+            digest = hashlib.sha256(asc.read()).hexdigest()
+        basedir = os.path.join(self.cachedir, 'gnupg')
+        gpgdir = os.path.join(basedir, digest)
+        if os.path.isdir(gpgdir):
+            logging.debug("Using cached gnupghome: '%s'", gpgdir)
+            os.utime(gpgdir, (time.time(), time.time()))
+            return gpgdir
+
+        os.makedirs(basedir, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=basedir)
+        try:
+            self._import_keys(tmpdir)
+            # nothing must be written to the directory when verifying
+            with open(os.path.join(tmpdir, 'gpg.conf'), 'w') as conf:
+                conf.write("lock-never\n"
+                           "no-auto-check-trustdb\n"
+                           "no-random-seed-file\n")
+            # the import may have started an agent for tmpdir
+            self.helpers.run_cmd(
+                ['gpgconf', '--homedir', tmpdir, '--kill', 'gpg-agent'],
+                cwd=None)
+            try:
+                os.rename(tmpdir, gpgdir)
+            except OSError:
+                # another run has created it in the meantime
+                if not os.path.isdir(gpgdir):
+                    raise
+        finally:
+            if os.path.isdir(tmpdir):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        return gpgdir
+
     def _revert_gpg_settings(self):
         if self._backup_gnupghome:
             os.putenv('GNUPGHOME', self._backup_gnupghome)
@@ -3,9 +3,18 @@ import os
 import re
 import sys
 import shutil
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
 
 from TarSCM.scm.base import Scm
 from TarSCM.exceptions import GitError
+from TarSCM.gitobjects import GitTree, GitSession, CommitLog, FULL_SHA, \
+    checkout_needed
+from TarSCM.gitmirror import clone_branch, depth_args, history_depth, \
+    mirror_refspecs, needs_parent_tag, other_ref, parent_tag_reached
+from TarSCM.revinfo import RevisionInfo
+from TarSCM.signatures import SignatureCache
 
 
 def search_tags(comment, limit=None):
@@ -20,12 +29,25 @@ def search_tags(comment, limit=None):
     return result
 
 
+def log_tags(lines):
+    """Generator of the tags in the lines of
+    'git log --pretty=format:%H %D'."""
+    for line in lines:
+        commit = line.split(" ", 1)
+        if len(commit) > 1:
+            for tag in search_tags(commit[1]):
+                yield re.sub(",$", '', tag)
+
+
 class Git(Scm):
     scm = 'git'
     _stash_pop_required = False
     partial_clone = False
+    separate_working_copy = True
 
     def __init__(self, args, task):
+        self._session          = None
+        self._commit_log       = None
         super().__init__(args, task)
         if not os.getenv('GIT_CONFIG_GLOBAL', None):
             os.putenv('GIT_CONFIG_GLOBAL', '/dev/null')
@@ -43,6 +65,37 @@ class Git(Scm):
             scmcmd += ['-c', 'https.proxy=' + self.httpsproxy]
         return scmcmd
 
+    def _get_session(self):
+        """Returns the GitSession for metadata queries in clone_dir."""
+        if self._session and self._session.cwd != self.clone_dir:
+            self._close_session()
+        if not self._session:
+            self._session = GitSession(self._get_scm_cmd(), self.clone_dir)
+        return self._session
+
+    def _close_session(self):
+        """Stop the session, needs to be called after refs or objects
+        have been changed."""
+        if self._session:
+            self._session.close()
+            self._session = None
+
+    def _revision_info(self, rev='HEAD'):
+        """Returns the RevisionInfo of the commit rev refers to or None."""
+        memo_dir = None
+        if self.repocachedir:
+            memo_dir = os.path.join(self.repocachedir, 'revinfo')
+        return RevisionInfo.lookup(self._get_session(), rev, memo_dir,
+                                   self.args.match_tag)
+
+    def _expand_parent_tag(self):
+        if self.revision == "@PARENT_TAG@":
+            self.revision = self._detect_parent_tag()
+            if not self.revision:
+                sys.exit("\033[31mNo parent tag present for the checked out "
+                         "revision, thus @PARENT_TAG@ cannot be expanded."
+                         "\033[0m")
+
     def switch_revision(self):
         """Switch sources to revision. The git revision may refer to any of the
         following:
@@ -58,12 +111,7 @@ class Git(Scm):
         logging.debug("[switch_revision] Starting ...")
         self.revision = self.revision or 'master'
 
-        if self.revision == "@PARENT_TAG@":
-            self.revision = self._detect_parent_tag()
-            if not self.revision:
-                sys.exit("\033[31mNo parent tag present for the checked out "
-                         "revision, thus @PARENT_TAG@ cannot be expanded."
-                         "\033[0m")
+        self._expand_parent_tag()
 
         if self.args.latest_signed_commit:
             self.revision = self.find_latest_signed_commit('HEAD')
@@ -83,10 +131,28 @@ class Git(Scm):
             # LANG=C to get a reliable output
             self._stash_and_merge()
 
+        if getattr(self.args, 'stream_objects', False):
+            reason = checkout_needed(self.args, self.partial_clone,
+                                     self.in_osc)
+            if not reason:
+                self.object_tree = GitTree(self._get_scm_cmd(),
+                                           self.clone_dir, self.revision)
+                reason = self.object_tree.needs_checkout(
+                    self.args.submodules != 'disable', self.args.subdir)
+            if reason:
+                logging.info("Not streaming from git objects: %s", reason)
+                if self.object_tree:
+                    self.object_tree.close()
+                self.object_tree = None
+
         # is doing the checkout in a hard way
         # may not exist before when using cache
+        # (when streaming from the objects only HEAD is needed)
+        mode = '--soft' if self.object_tree else '--hard'
+        if self.partial_clone:
+            self._prefetch_objects(self.revision)
         self.helpers.safe_run(
-            self._get_scm_cmd() + ['reset', '--hard', self.revision],
+            self._get_scm_cmd() + ['reset', mode, self.revision],
             cwd=self.clone_dir
         )
 
@@ -96,6 +162,7 @@ class Git(Scm):
                 self._get_scm_cmd() + ['submodule', 'update', '--recursive'],
                 cwd=self.clone_dir
             )
+        self._close_session()
 
     def _stash_and_merge(self):
         lang_bak = None
@@ -122,6 +189,8 @@ class Git(Scm):
                 cwd=self.clone_dir,
                 interactive=True)
 
+        self._close_session()
+
         # validate the existens of the revision
         if self.revision and not self._ref_exists(self.revision):
             sys.exit('%s: No such revision' % self.revision)
@@ -137,18 +206,26 @@ class Git(Scm):
         """SCM specific version of fetch_uptream for git."""
         self.auth_url()
 
-        # clone if no .git dir exists
-        command = self._get_scm_cmd() + ['clone',
-                                         self.url, self.clone_dir]
-        if self.partial_clone:
-            command.append('--filter=tree:0')
-        if not self.is_sslverify_enabled():
-            command += ['--config', 'http.sslverify=false']
         if self.repocachedir and not self.partial_clone:
-            command.insert(command.index('clone') + 1, '--mirror')
-
-        wdir = os.path.abspath(os.path.join(self.repodir, os.pardir))
-        self.run_and_hide(command, wdir, [os.path.join(wdir, self.clone_dir)])
+            self._init_mirror()
+        else:
+            # clone if no .git dir exists
+            command = self._get_scm_cmd() + ['clone',
+                                             self.url, self.clone_dir]
+            if self.partial_clone:
+                command.append('--filter=' + self.clone_filter)
+            if self._fetch_depth():
+                command.extend(['--depth', str(self._fetch_depth())])
+                if clone_branch(self.revision):
+                    command.extend(['--branch', self.revision])
+            if self.sparse_checkout:
+                command.append('--no-checkout')
+            if not self.is_sslverify_enabled():
+                command += ['--config', 'http.sslverify=false']
+
+            wdir = os.path.abspath(os.path.join(self.repodir, os.pardir))
+            self.run_and_hide(command, wdir,
+                              [os.path.join(wdir, self.clone_dir)])
 
         if self.partial_clone:
             config_command = self._get_scm_cmd() + ['config', '--local',
@@ -167,29 +244,132 @@ class Git(Scm):
                     cfg_cmd, cwd=self.clone_dir,
                     interactive=sys.stdout.isatty())
 
-        if self.revision == "@PARENT_TAG@":
-            self.revision = self._detect_parent_tag()
-            if not self.revision:
-                sys.exit("\033[31mNo parent tag present for the checked out "
-                         "revision, thus @PARENT_TAG@ cannot be expanded."
-                         "\033[0m")
+        # without cache clone_dir is the working copy
+        if self.sparse_checkout and not self.repocachedir:
+            self._setup_sparse_checkout()
+
+        self._expand_parent_tag()
 
         self.fetch_specific_revision()
 
         if self.revision and not self.repocachedir:
+            if self.partial_clone:
+                self._prefetch_objects(self.revision)
             self.helpers.safe_run(
                 self._get_scm_cmd() + ['checkout', self.revision],
                 cwd=self.clone_dir
             )
 
+    def _init_mirror(self):
+        """Create the mirror cache. Unlike 'git clone --mirror' it only
+        fetches the refs a run needs (see mirror_refspecs()), so e.g. the
+        refs/pull/* or refs/changes/* of a hosting service stay upstream."""
+        wdir = os.path.abspath(os.path.join(self.repodir, os.pardir))
+        self.helpers.safe_run(
+            self._get_scm_cmd() + ['init', '--bare', '--quiet',
+                                   self.clone_dir],
+            cwd=wdir)
+        settings = [('remote.origin.url', self.url)]
+        if not self.is_sslverify_enabled():
+            settings.append(('http.sslverify', 'false'))
+        for (key, value) in settings:
+            self.helpers.safe_run(
+                self._get_scm_cmd() + ['config', '--local', key, value],
+                cwd=self.clone_dir)
+
+        try:
+            self._fetch_mirror()
+        except SystemExit:
+            # don't leave an empty mirror behind for the next run
+            shutil.rmtree(self.clone_dir)
+            raise
+
+        # the working copy is cloned from the mirror and checks out its HEAD
+        rcode, output = self.helpers.run_cmd(
+            self._get_scm_cmd() + ['ls-remote', '--symref', 'origin', 'HEAD'],
+            cwd=self.clone_dir)
+        if not rcode and output.startswith('ref: '):
+            head = output[len('ref: '):].split('\t', 1)[0]
+            self.helpers.safe_run(
+                self._get_scm_cmd() + ['symbolic-ref', 'HEAD', head],
+                cwd=self.clone_dir)
+
+    def _fetch_mirror(self):
+        """Fetch the refs of mirror_refspecs() into the mirror cache with
+        a single negotiation."""
+        command = self._get_scm_cmd() + ['fetch', '--no-tags'] + \
+            depth_args(self.clone_dir) + ['origin'] + \
+            mirror_refspecs(self.args, self.revision)
+        self.run_and_hide(command, self.clone_dir)
+        self._close_session()
+
+    def _setup_sparse_checkout(self):
+        """Restrict the working copy to what gets packed (see
+        Scm._sparse_checkout_args()), so the checkout only downloads and
+        writes the blobs needed."""
+        command = self._get_scm_cmd() + ['sparse-checkout', 'set']
+        self.helpers.safe_run(command + self.sparse_checkout,
+                              cwd=self.clone_dir)
+
+    def _prefetch_objects(self, rev):
+        """Fetch the objects a checkout of rev lacks in a partial clone with
+        one 'git fetch --stdin' per round (trees, then blobs) instead of
+        letting git fetch them lazily on demand."""
+        cmd = self._get_scm_cmd() + ['rev-list', '--objects', '--no-walk',
+                                     '--missing=print']
+        if self.sparse_checkout:
+            # the checkout fetches the blobs matching the sparse patterns
+            # in one batch itself
+            cmd.append('--filter=blob:none')
+        cmd.append(rev)
+        fetch = self._get_scm_cmd() + ['-c',
+                                       'fetch.negotiationAlgorithm=noop',
+                                       'fetch', '--no-tags',
+                                       '--no-write-fetch-head',
+                                       '--recurse-submodules=no',
+                                       '--filter=blob:none', '--stdin',
+                                       'origin']
+        previous = None
+        while True:
+            rcode, output = self.helpers.run_cmd(cmd, self.clone_dir)
+            missing = [line[1:] for line in output.splitlines()
+                       if line.startswith('?')]
+            # git reports unknown revisions later on
+            if rcode or not missing or missing == previous:
+                break
+            logging.debug("Prefetching %d objects", len(missing))
+            logging.debug("COMMAND: %s", fetch)
+            proc = subprocess.Popen(fetch, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    cwd=self.clone_dir)
+            output = proc.communicate('\n'.join(missing).encode('ascii'))[0]
+            if proc.returncode:
+                # lazy fetching still works
+                logging.debug("Prefetch failed(%d): %s", proc.returncode,
+                              repr(output))
+                break
+            previous = missing
+        self._close_session()
+
     def fetch_specific_revision(self):
-        if self.revision and not self._ref_exists(self.revision):
+        if not self.revision:
+            return
+        ref = other_ref(self.revision) if self.repocachedir else None
+        if ref and not self._is_branch_or_tag(self.revision):
+            # the mirror refspecs don't cover it, so follow its updates
+            rev = '+%s:%s' % (self.revision, ref)
+        elif not self._ref_exists(self.revision):
             rev = self.revision + ':' + self.revision
-            command = self._get_scm_cmd() + ['fetch', self.url, rev]
-            if self.partial_clone:
-                command.append('--filter=tree:0')
-            # fetch reference from url and create locally
-            self.run_and_hide(command, self.clone_dir)
+        else:
+            return
+        command = self._get_scm_cmd() + ['fetch', self.url, rev]
+        if self.partial_clone:
+            command.append('--filter=' + self.clone_filter)
+        command.extend(depth_args(self.clone_dir, self._fetch_depth()))
+        # fetch reference from url and create locally
+        self.run_and_hide(command, self.clone_dir)
+        self._close_session()
 
     def fetch_submodules(self):
         """Recursively initialize git submodules."""
@@ -235,21 +415,17 @@ class Git(Scm):
                 interactive=sys.stdout.isatty()
             )
 
-            command = self._get_scm_cmd() + ['fetch', '--tags']
-            if self.partial_clone:
-                command.append('--filter=tree:0')
+            if self.repocachedir and not self.partial_clone:
+                self._fetch_mirror()
+                self.fetch_specific_revision()
+                return
 
-            self.helpers.safe_run(
-                command,
-                cwd=self.clone_dir,
-                interactive=sys.stdout.isatty()
-            )
-
-            command = self._get_scm_cmd() + ['fetch']
+            # '--tags' fetches the tags along with the branches
+            command = self._get_scm_cmd() + ['fetch', '--tags']
             if self.partial_clone:
-                command.append('--filter=tree:0')
-
+                command.append('--filter=' + self.clone_filter)
             self.run_and_hide(command, self.clone_dir)
+            self._close_session()
 
         except SystemExit as exc:
             logging.error("Corrupt clone_dir '%s' detected.", self.clone_dir)
@@ -294,22 +470,41 @@ class Git(Scm):
             if os.path.exists(revpath):
                 log_cmd.append('--')
 
+        revinfo = self._revision_info(self.revision or 'HEAD')
+        if revinfo:
+            return revinfo.format(log_cmd)
         version = self.helpers.safe_run(log_cmd, self.clone_dir)[1]
         return version
 
     def _detect_parent_tag(self):
-        parent_tag = ''
-        cmd = self._get_scm_cmd() + ['describe', '--tags', '--abbrev=0']
-        if self.args.match_tag:
-            cmd.append("--match=%s" % self.args.match_tag)
-
-        rcode, output = self.helpers.run_cmd(cmd, self.clone_dir)
-
-        if rcode == 0:
-            # strip to remove newlines
-            parent_tag = output.strip()
-
-        return parent_tag
+        if needs_parent_tag(self.args):
+            self._deepen_to_parent_tag('HEAD')
+        revinfo = self._revision_info('HEAD')
+        if not revinfo:
+            return ''
+        return revinfo.parent_tag()
+
+    def _fetch_depth(self):
+        """Returns the depth of a clone without cache (see history_depth())
+        or None. The caches stay complete, the working copies borrow their
+        objects."""
+        if self.repocachedir or self.in_osc:
+            return None
+        return history_depth(self.args)
+
+    def _deepen_to_parent_tag(self, rev):
+        """Deepen a shallow clone step by step, doubling the depth, until
+        the history between rev and its parent tag is complete."""
+        depth = 1
+        while not parent_tag_reached(self._get_scm_cmd(), self.clone_dir, rev,
+                                     self.args.match_tag):
+            command = self._get_scm_cmd() + ['fetch', '--deepen=%d' % depth,
+                                             'origin']
+            if self.partial_clone:
+                command.append('--filter=' + self.clone_filter)
+            self.run_and_hide(command, self.clone_dir)
+            self._close_session()
+            depth *= 2
 
     def _detect_version_parent_tag(self, parent_tag, versionformat):  # noqa pylint: disable=no-self-use
         if not parent_tag:
@@ -326,29 +521,62 @@ class Git(Scm):
             sys.exit("\033[31m@TAG_OFFSET@ cannot be expanded, "
                      "as no parent tag was discovered.\033[0m")
 
-        cmd = self._get_scm_cmd()
-        cmd.extend(['rev-list', '--count', parent_tag + '..HEAD'])
-        rcode, out = self.helpers.run_cmd(cmd, self.clone_dir)
+        revinfo = self._revision_info('HEAD')
+        if not revinfo:
+            sys.exit("\033[31m@TAG_OFFSET@ can not be expanded: "
+                     "HEAD is no commit\033[0m")
 
-        if rcode:
-            msg = "\033[31m@TAG_OFFSET@ can not be expanded: {}\033[0m"
-            msg = msg.format(out)
-            sys.exit(msg)
-
-        tag_offset = out.strip()
+        tag_offset = revinfo.tag_offset(parent_tag)
         versionformat = re.sub('@TAG_OFFSET@', tag_offset,
                                versionformat)
         return versionformat
 
     def get_timestamp(self):
+        revinfo = self._revision_info(self.revision or 'HEAD')
+        if revinfo:
+            return revinfo.commit_time()
+        # let git log report the problem
         data = {"parent_tag": None, "versionformat": "%ct"}
         timestamp = self.detect_version(data)
         return int(timestamp)
 
+    def remote_revision(self):
+        """Look up the revision upstream with a single 'git ls-remote'.
+        Like the working copy, a tag wins over a branch of the same name."""
+        revision = self.revision or 'master'
+        if FULL_SHA.match(revision):
+            return revision
+        self.auth_url()
+        command = self._get_scm_cmd()
+        if not self.is_sslverify_enabled():
+            command += ['-c', 'http.sslverify=false']
+        command += ['ls-remote', self.url, revision, revision + '^{}']
+        rcode, output = self.helpers.run_cmd(command, cwd=None)
+        if rcode:
+            logging.debug("Could not ask upstream for '%s'", revision)
+            return None
+
+        refs = {}
+        for line in output.splitlines():
+            if '\t' in line:
+                (sha, ref) = line.split('\t', 1)
+                refs[ref] = sha
+        if revision.startswith('refs/'):
+            candidates = [revision]
+        else:
+            candidates = ['refs/tags/' + revision, 'refs/heads/' + revision]
+        for ref in candidates:
+            # the commit of an annotated tag
+            sha = refs.get(ref + '^{}') or refs.get(ref)
+            if sha:
+                return sha
+        return None
+
     def get_current_commit(self):
-        return self.helpers.safe_run(self._get_scm_cmd() + ['rev-parse',
-                                                            'HEAD'],
-                                     self.clone_dir)[1].rstrip()
+        commit = self._get_session().rev_parse('HEAD')
+        if not commit:
+            sys.exit("%s: HEAD does not point to a commit" % self.clone_dir)
+        return commit
 
     def get_current_branch(self):
         return self.helpers.safe_run(self._get_scm_cmd() + ['rev-parse',
@@ -356,13 +584,36 @@ class Git(Scm):
                                                             'HEAD'],
                                      self.clone_dir)[1].rstrip()
 
+    def _fetch_signature(self):
+        if self.repocachedir and not self.partial_clone:
+            refspecs = mirror_refspecs(self.args, self.revision)
+            return ' '.join(refspecs + depth_args(self.clone_dir))
+        return self.clone_filter if self.partial_clone else ''
+
+    def _revision_present(self):
+        """Full commit ids and tags are treated as immutable."""
+        revision = self.revision or ''
+        args     = self.args
+        if args.latest_signed_commit or args.latest_signed_tag:
+            return False
+        # the history is still missing
+        if depth_args(self.clone_dir):
+            return False
+        if FULL_SHA.match(revision) or revision.startswith('refs/tags/'):
+            ref = revision
+        elif revision and not revision.startswith(('refs/', '@')):
+            ref = 'refs/tags/' + revision
+        else:
+            return False
+        return self._get_session().rev_parse(ref + '^{commit}') is not None
+
     def _ref_exists(self, rev):
-        rcode, _ = self.helpers.run_cmd(
-            self._get_scm_cmd() + ['rev-parse', '--verify', '--quiet', rev],
-            cwd=self.clone_dir,
-            interactive=sys.stdout.isatty()
-        )
-        return rcode == 0
+        return self._get_session().rev_parse(rev) is not None
+
+    def _is_branch_or_tag(self, rev):
+        session = self._get_session()
+        refs = ['refs/heads/' + rev, 'refs/tags/' + rev]
+        return any(session.rev_parse(ref) is not None for ref in refs)
 
     def _log_cmd(self, cmd_args, subdir):
         """ Helper function to call 'git log' with args"""
@@ -408,25 +659,73 @@ class Git(Scm):
 
         # We use a temporary shared clone to avoid race conditions
         # between multiple services
-        org_clone_dir = self.clone_dir
+        mirror_dir = self.clone_dir
         self.clone_dir = self.repodir
+
+        # The mirror has just been updated and contains all refs the run
+        # needs, so the working copy is cloned from it without
+        # contacting upstream. Partial clones fetch missing objects from
+        # upstream anyway and keep using '--reference'.
+        from_mirror = not self.partial_clone and not self.args.package_meta
+        if from_mirror:
+            self._clone_from_mirror(mirror_dir)
+        else:
+            self._clone_with_cache(mirror_dir)
+
+        if self.sparse_checkout:
+            self._setup_sparse_checkout()
+
+        self._expand_parent_tag()
+
+        if self.revision and not self._ref_exists(self.revision):
+            refspec = self.revision + ":" + self.revision
+            if from_mirror and self._fetch_from_mirror(mirror_dir, refspec):
+                return
+            cmd = self._get_scm_cmd() + ['fetch', 'origin',
+                                         refspec]
+            if self.partial_clone:
+                cmd.append('--filter=' + self.clone_filter)
+            self.helpers.safe_run(
+                cmd, cwd=self.clone_dir, interactive=sys.stdout.isatty())
+            self._close_session()
+
+    def _clone_from_mirror(self, mirror_dir):
+        """Clone the working copy from the mirror. '--shared' borrows the
+        objects of the mirror like '--reference' does."""
+        command = self._get_scm_cmd() + ['clone', '--no-checkout',
+                                         '--shared', mirror_dir,
+                                         self.clone_dir]
+        wdir = os.path.abspath(os.path.join(self.clone_dir, os.pardir))
+        self.run_and_hide(command, wdir)
+
+        # origin must point to upstream, e.g. for relative submodule
+        # urls or revisions which are not in the mirror
+        self.helpers.safe_run(
+            self._get_scm_cmd() + ['config', '--local',
+                                   'remote.origin.url', self.url],
+            cwd=self.clone_dir)
+
+    def _fetch_from_mirror(self, mirror_dir, refspec):
+        """Fetch a revision which has been fetched into the mirror before.
+        Returns False if the mirror doesn't have it."""
+        cmd = self._get_scm_cmd() + ['fetch', mirror_dir, refspec]
+        rcode, _ = self.helpers.run_cmd(cmd, cwd=self.clone_dir)
+        self._close_session()
+        return rcode == 0
+
+    def _clone_with_cache(self, cache_dir):
+        """Clone the working copy for partial clones and --package-meta,
+        which can't be cloned from the mirror."""
         command = self._get_scm_cmd() + ['clone',
                                          '--no-checkout']
         if self.partial_clone:
-            command.append('--filter=tree:0')
-        use_reference = True
+            command.append('--filter=' + self.clone_filter)
 
-        try:
-            if (self.args.package_meta and not self.partial_clone):
-                logging.info("Not using '--reference'")
-                use_reference = False
-        except KeyError:
-            pass
-
-        if use_reference:
-            command.extend(['--reference', org_clone_dir, self.url])
+        if self.args.package_meta and not self.partial_clone:
+            logging.info("Not using '--reference'")
+            command.append(cache_dir)
         else:
-            command.append(org_clone_dir)
+            command.extend(['--reference', cache_dir, self.url])
         command.append(self.clone_dir)
         wdir = os.path.abspath(os.path.join(self.clone_dir, os.pardir))
 
@@ -449,24 +748,11 @@ class Git(Scm):
                     cfg_cmd, cwd=self.clone_dir,
                     interactive=sys.stdout.isatty())
 
-        if self.revision == "@PARENT_TAG@":
-            self.revision = self._detect_parent_tag()
-            if not self.revision:
-                sys.exit("\033[31mNo parent tag present for the checked out "
-                         "revision, thus @PARENT_TAG@ cannot be expanded."
-                         "\033[0m")
-
-        if self.revision and not self._ref_exists(self.revision):
-            refspec = self.revision + ":" + self.revision
-            cmd = self._get_scm_cmd() + ['fetch', 'origin',
-                                         refspec]
-            if self.partial_clone:
-                cmd.append('--filter=tree:0')
-            self.helpers.safe_run(
-                cmd, cwd=self.clone_dir, interactive=sys.stdout.isatty())
-
     def cleanup(self):
         logging.debug("Doing cleanup")
+        if self.object_tree:
+            self.object_tree.close()
+        self._close_session()
         if self._stash_pop_required:
             logging.debug("Stash pop required!")
             branch = self._stash_pop_required[0]
@@ -503,20 +789,77 @@ class Git(Scm):
         # Deny by default, might be local path
         return False
 
+    def _load_signature_cache(self):
+        """Returns the SignatureCache for the keyring given by
+        --maintainers-asc or None if there is no repository cache."""
+        if not self.repocachedir or not self.args.maintainers_asc:
+            return None
+        return SignatureCache(
+            os.path.join(self.repocachedir, 'signatures.json'),
+            self.args.maintainers_asc)
+
     def find_latest_signed_commit(self, commit):
+        """The history is traversed in memory with the parents and the
+        signature status from 'git log' (see CommitLog). Only the
+        signatures the result is based on are confirmed by
+        'git verify-commit'."""
         if not commit:
             commit = 'HEAD'
-        cmd = ['git', 'rev-list', '-n1', commit]
-        result = self.helpers.safe_run(cmd, cwd=self.clone_dir)
-        commit = result[1].rstrip()
+        sha = self._get_session().rev_parse(commit + '^{commit}')
+        if not sha:
+            sys.exit("%s: No such commit" % commit)
 
+        cache = self._load_signature_cache()
+        self._commit_log = CommitLog(self._get_scm_cmd(), self.clone_dir, sha,
+                                     cache)
+        try:
+            while True:
+                self._commit_log.trusted.clear()
+                candidate = self._find_signed_commit(sha)
+                if not candidate:
+                    return None
+                rejected = [c for c in sorted(self._commit_log.trusted)
+                            if not self._verify_commit(c)]
+                if not rejected:
+                    return candidate
+                for rej in rejected:
+                    logging.debug("Signature of %s could not be confirmed",
+                                  rej)
+                    self._commit_log.reject(rej)
+        finally:
+            self._commit_log.close()
+            self._commit_log = None
+            if cache:
+                cache.save()
+
+    def _find_signed_commit(self, commit):
         while commit:
-            parents = self.get_parents(commit)
+            parents = self._commit_parents(commit)
             (commit, c_ok) = self.check_commit(commit, parents)
             if c_ok:
                 return commit
         return None
 
+    def _verify_commit(self, sha1):
+        cache = self._commit_log.cache if self._commit_log else None
+        if cache and cache.get('commit', sha1) is not None:
+            return cache.get('commit', sha1)
+        cmd = ['git', 'verify-commit', sha1]
+        result = self.helpers.run_cmd(cmd, cwd=self.clone_dir)
+        if cache:
+            cache.set('commit', sha1, not result[0])
+        return not result[0]
+
+    def _commit_signed(self, sha1):
+        if self._commit_log:
+            return self._commit_log.signed(sha1)
+        return self._verify_commit(sha1)
+
+    def _commit_parents(self, sha1):
+        if self._commit_log:
+            return self._commit_log.parents(sha1)
+        return self.get_parents(sha1)
+
     def check_commit(self, current_commit, parents):
         # pylint: disable=R0911,R0912
         left_parent = None
@@ -531,9 +874,7 @@ class Git(Scm):
         if not current_commit:
             return ('', 0)
 
-        cmd = ['git', 'verify-commit', current_commit]
-        result = self.helpers.run_cmd(cmd, cwd=self.clone_dir)
-        if not result[0]:
+        if self._commit_signed(current_commit):
             return (current_commit, 1)
 
         if right_parent:
@@ -541,7 +882,7 @@ class Git(Scm):
                 current_commit,
                 [right_parent])
             if c_ok[1]:
-                parents = self.get_parents(left_parent)
+                parents = self._commit_parents(left_parent)
                 if len(parents) > 1:
                     mie = self.merge_is_empty(current_commit)
                     if mie:
@@ -556,16 +897,13 @@ class Git(Scm):
                     if c_ok[1]:
                         return (current_commit, 1)
         elif left_parent:
-            parents = self.get_parents(left_parent)
+            parents = self._commit_parents(left_parent)
             if len(parents) > 1:
                 c_ok = self.check_commit(current_commit, parents)
                 if c_ok[1]:
                     return (left_parent, 1)
-            else:
-                cmd = ['git', 'verify-commit', left_parent]
-                result = self.helpers.run_cmd(cmd, cwd=self.clone_dir)
-                if not result[0]:
-                    return (left_parent, 1)
+            elif self._commit_signed(left_parent):
+                return (left_parent, 1)
 
         return (left_parent, 0)
 
@@ -578,40 +916,79 @@ class Git(Scm):
         return 1
 
     def get_parents(self, sha1):
-        cmd  = ['git', 'rev-list', '--parents', '-n', '1', sha1]
-        result = self.helpers.safe_run(cmd, cwd=self.clone_dir)
-        parents = result[1].rstrip().split(" ")
-        fcm = parents.pop(0)
-        if fcm != sha1:
-            raise GitError("First commit %s no equal sha1 %s" % (fcm, sha1))
-        if parents:
-            return parents
-        return []
+        commit = self._get_session().commit(sha1)
+        if not commit:
+            sys.exit("%s: No such commit" % sha1)
+        if commit['sha'] != sha1:
+            raise GitError("First commit %s no equal sha1 %s" %
+                           (commit['sha'], sha1))
+        return commit['parents']
 
     def find_latest_signed_tag(self):
+        """Returns the first tag in topological order of the history which
+        'git verify-tag' accepts.
+
+        The log is read as a stream, which is stopped as soon as a tag has
+        been verified. The tags are verified in parallel in batches of
+        twice the number of cpus."""
         revision = None
+        workers = os.cpu_count() or 1
+        cache = self._load_signature_cache()
 
-        result = self.helpers.safe_run(
-            ['git', 'log', '--pretty=format:%H %G? %h %D', "--topo-order"],
+        lines = self.helpers.stream_cmd(
+            ['git', 'log', '--pretty=format:%H %D', "--topo-order"],
             cwd=self.clone_dir)
-
-        lines = result[1].split("\n")
-        while lines:
-            line = lines.pop(0)
-            commit = line.split(" ", 3)
-            if len(commit) > 3:
-                for tag in search_tags(commit[3]):
-                    tag = re.sub(",$", '', tag)
-                    verify = self.helpers.run_cmd(
-                        ['git', 'verify-tag', tag],
-                        cwd=self.clone_dir)
-                    if verify[0] == 0:
-                        revision = self._parent_tag = tag
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                batch = []
+                for tag in log_tags(lines):
+                    batch.append(tag)
+                    if len(batch) < 2 * workers:
+                        continue
+                    revision = self._first_verified_tag(executor, batch,
+                                                        cache)
+                    if revision:
                         break
-            if revision:
-                break
-
-        if not revision:
+                    batch = []
+                else:
+                    revision = self._first_verified_tag(executor, batch,
+                                                        cache)
+        finally:
+            lines.close()
+            if cache:
+                cache.save()
+
+        if revision:
+            self._parent_tag = revision
+        else:
             logging.debug("No signed tag found!")
 
         return revision
+
+    def _first_verified_tag(self, executor, tags, cache):
+        results = {}
+        todo    = []
+        for tag in tags:
+            sha = None
+            if cache:
+                sha = self._get_session().rev_parse('refs/tags/' + tag)
+            if sha and cache.get('tag', sha) is not None:
+                results[tag] = cache.get('tag', sha)
+            else:
+                todo.append((tag, sha))
+
+        verified = executor.map(self._verify_tag, [tag for (tag, _) in todo])
+        for ((tag, sha), result) in zip(todo, verified):
+            results[tag] = result
+            if sha:
+                cache.set('tag', sha, result)
+
+        for tag in tags:
+            if results[tag]:
+                return tag
+        return None
+
+    def _verify_tag(self, tag):
+        verify = self.helpers.run_cmd(['git', 'verify-tag', tag],
+                                      cwd=self.clone_dir)
+        return verify[0] == 0
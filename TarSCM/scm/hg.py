@@ -126,6 +126,39 @@ class Hg(Scm):
 
         return self.helpers.safe_run(cmd, self.clone_dir)[1]
 
+    def get_current_commit(self):
+        cmd = self._get_scm_cmd() + ['log', '-r', '.', '--template',
+                                     '{node}']
+        return self.helpers.safe_run(cmd, self.clone_dir)[1].strip()
+
+    def _fetch_signature(self):
+        # 'hg pull' fetches everything, switch_revision() updates
+        return ''
+
+    def _revision_present(self):
+        """Full changeset ids are treated as immutable."""
+        if not re.match('^[0-9a-f]{40}$', self.revision or ''):
+            return False
+        cmd = self._get_scm_cmd() + ['log', '-r', self.revision,
+                                     '--template', '{node}']
+        rcode, _ = self.helpers.run_cmd(cmd, cwd=self.clone_dir)
+        return not rcode
+
+    def remote_revision(self):
+        """Look up the revision upstream with 'hg identify'."""
+        self.auth_url()
+        cmd = self._get_scm_cmd() + ['identify', '--template', '{node}',
+                                     '-r', self.revision or 'tip']
+        if not self.is_sslverify_enabled():
+            cmd += ['--insecure']
+        cmd.append(self.url)
+        rcode, output = self.helpers.run_cmd(cmd, cwd=None)
+        output = output.strip()
+        if rcode or not re.match('^[0-9a-f]{40}$', output):
+            logging.debug("Could not ask upstream for '%s'", self.revision)
+            return None
+        return output
+
     def get_timestamp(self):
         data = {"parent_tag": None, "versionformat": "{date}"}
         timestamp = self.detect_version(data)
@@ -160,6 +160,39 @@ class Svn(Scm):
         timestamp = dateutil.parser.parse(timestamp).strftime("%s")
         return int(timestamp)
 
+    def get_current_commit(self):
+        # the revision doesn't pin what svn:externals pull in, so neither
+        # the obsinfo nor the artifact cache can refer to it
+        if self._has_externals():
+            return None
+        cmd = self._get_scm_cmd() + ['info', '--show-item',
+                                     'last-changed-revision']
+        return self.helpers.safe_run(cmd, self.clone_dir)[1].strip()
+
+    def _has_externals(self):
+        # '--xml' tells the properties apart from warnings about missing
+        # ones
+        cmd = self._get_scm_cmd() + ['propget', '--xml', '-R',
+                                     'svn:externals', '.']
+        output = self.helpers.run_cmd(cmd, self.clone_dir)[1]
+        return 'name="svn:externals"' in output
+
+    def remote_revision(self):
+        """Look up the revision upstream with 'svn info'."""
+        cmd = self._get_scm_cmd() + ['info', '--non-interactive',
+                                     '--show-item', 'last-changed-revision']
+        if self.revision:
+            cmd.append('-r%s' % self.revision)
+        if not self.is_sslverify_enabled():
+            cmd.append('--trust-server-cert')
+        cmd.append(self.url)
+        rcode, output = self.helpers.run_cmd(cmd, cwd=None)
+        output = output.strip()
+        if rcode or not output.isdigit():
+            logging.debug("Could not ask upstream for '%s'", self.revision)
+            return None
+        return output
+
     def detect_changes_scm(self, chgs):
         """Detect changes between SVN revisions."""
         last_rev = chgs['revision']
@@ -0,0 +1,62 @@
+'''
+This module contains the class SignatureCache
+'''
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+
+class SignatureCache():
+    '''
+    Results of signature checks of git objects, stored in a json file in
+    the repository cache.
+
+    Signed objects never change, but the result of a check depends on the
+    keyring. The file therefore only holds the results for one keyring
+    (identified by the hash of its content) and is started from scratch
+    when a different keyring is used.
+    '''
+    def __init__(self, filename, keyring):
+        self.filename = filename
+        self.results  = {}
+        self.changed  = False
+        with open(keyring, 'rb') as kfh:
+            self.keyring = hashlib.sha256(kfh.read()).hexdigest()
+
+        try:
+            with open(filename) as cfh:
+                data = json.load(cfh)
+        except (IOError, OSError, ValueError):
+            data = {}
+        if data.get('keyring') == self.keyring:
+            self.results = data.get('objects', {})
+        elif data:
+            logging.debug("Keyring changed, dropping signature cache '%s'",
+                          filename)
+
+    def get(self, kind, sha):
+        """Returns the cached result for the object sha of type kind
+        ('commit' or 'tag') or None."""
+        return self.results.get(kind + ':' + sha)
+
+    def set(self, kind, sha, result):
+        if self.results.get(kind + ':' + sha) != result:
+            self.results[kind + ':' + sha] = result
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        dirname = os.path.dirname(self.filename)
+        try:
+            (fdesc, tmpname) = tempfile.mkstemp(prefix='.tmp-', dir=dirname)
+            with os.fdopen(fdesc, 'w') as cfh:
+                json.dump({'keyring': self.keyring, 'objects': self.results},
+                          cfh, sort_keys=True)
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError) as exc:
+            logging.debug("Could not write '%s': %s", self.filename, exc)
+            return
+        self.changed = False
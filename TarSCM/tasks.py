@@ -19,10 +19,49 @@ import yaml
 import TarSCM.scm
 import TarSCM.archive
 from TarSCM.helpers import Helpers, file_write_legacy
+from TarSCM.artifacts import ArtifactCache, ProbeRecord, snapshot_dir, \
+    changed_files
 from TarSCM.changes import Changes
 from TarSCM.exceptions import OptionsError
 
 
+def _probe_record(scm_object, args):
+    '''
+    Returns the ProbeRecord for --probe-remote or None if the result of
+    the run might differ although upstream still points to the same
+    commit (e.g. new tags or changes entries).
+    '''
+    if not args.probe_remote or not scm_object.cachedir:
+        return None
+    if args.changesgenerate or args.use_obs_gbp or \
+       args.latest_signed_commit or args.latest_signed_tag or \
+       args.submodules in ['main', 'master']:
+        return None
+    for value in (args.revision, args.version, args.versionformat):
+        if value and ('@PARENT_TAG@' in value or '@TAG_OFFSET@' in value):
+            return None
+    return ProbeRecord(scm_object.cachedir, args)
+
+
+def _reuse_unchanged(scm_object, args, probe):
+    '''
+    Restore the artifacts of the last run with the same parameters if
+    upstream still points to the commit of that run. Only costs a
+    single request to upstream and never touches the repository cache.
+    '''
+    commit = scm_object.remote_revision()
+    if not commit:
+        return False
+    cache = probe.lookup(commit)
+    if not cache:
+        logging.debug("Upstream changed or no earlier run for %s", commit)
+        return False
+    cache.restore(args.outdir)
+    logging.info("Upstream is still at %s, using cached artifacts from "
+                 "'%s'", commit, cache.entry_dir)
+    return True
+
+
 class Tasks():
     # pylint: disable=too-many-branches
     '''
@@ -221,16 +260,57 @@ class Tasks():
             print("Please install '%s'" % scm_object.scm)
             sys.exit(1)
 
+        probe = _probe_record(scm_object, args)
+        if probe and _reuse_unchanged(scm_object, args, probe):
+            scm_object.finalize()
+            return
+
         scm_object.fetch_upstream()
         version = self.get_version()
 
+        detected_changes = scm_object.detect_changes()
+
+        changesversion = self._build_artifacts(scm_object, version, probe)
+
+        if detected_changes:
+            self._process_changes(args,
+                                  version,
+                                  changesversion,
+                                  detected_changes)
+
+        # the working copy might borrow objects from the cache until here
+        scm_object.unlock_cache()
+        scm_object.finalize()
+
+    def _build_artifacts(self, scm_object, version, probe):
+        '''
+        Create the artifacts in the outdir or restore them from the artifact
+        cache. Returns the version for the changes entries.
+        '''
+        # the arguments of this task, which might differ from self.args
+        args = scm_object.args
         (dstname, changesversion, basename) = self._dstname(scm_object,
                                                             version)
 
         logging.debug("DST: %s", dstname)
 
-        detected_changes = scm_object.detect_changes()
-
+        cache = ArtifactCache.for_task(scm_object, args, version=version,
+                                       dstname=dstname, basename=basename)
+        if cache and cache.restore(args.outdir):
+            logging.info("Using cached artifacts from '%s'", cache.entry_dir)
+        else:
+            before = snapshot_dir(args.outdir) if cache else None
+            self._create_artifacts(scm_object, version, dstname, basename)
+            if cache:
+                after = snapshot_dir(args.outdir)
+                after.pop(os.path.basename(scm_object.arch_dir), None)
+                cache.store(args.outdir, changed_files(before, after))
+        if probe and cache:
+            probe.store(cache)
+        return changesversion
+
+    def _create_artifacts(self, scm_object, version, dstname, basename):
+        args = scm_object.args
         if not args.use_obs_gbp:
             scm_object.prep_tree_for_archive(args.subdir, args.outdir,
                                              dstname=dstname)
@@ -261,14 +341,6 @@ class Tasks():
             cli       = args
         )
 
-        if detected_changes:
-            self._process_changes(args,
-                                  version,
-                                  changesversion,
-                                  detected_changes)
-
-        scm_object.finalize()
-
     def _dstname(self, scm_object, version):
         args = self.args
         if args.filename:
@@ -9,10 +9,15 @@ import unittest
 import io
 import yaml
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 import TarSCM
 
 from TarSCM.scm.git import Git
-from TarSCM.archive import ObsCpio
+from TarSCM.archive import ObsCpio, FileFilter, sparse_checkout_patterns
 
 from tests.gitfixtures import GitFixtures
 from tests.scmlogs import ScmInvocationLogs
@@ -223,3 +228,149 @@ class ArchiveOBSCpioTestCases(unittest.TestCase):
         for fname in files_expected:
             self.assertTrue(os.path.exists(
                 os.path.join(outdir, fname)))
+
+    def test_cpio_repro_headers(self):
+        '''
+        Test that the native cpio writer normalizes the headers without
+        touching the files in the tree
+        '''
+        tc_name              = inspect.stack()[0][3]
+        cl_name              = self.__class__.__name__
+        c_dir                = os.path.join(self.tmp_dir, tc_name)
+        scmlogs              = ScmInvocationLogs('git', c_dir)
+        scmlogs.nextlog('start-test')
+        fixture              = GitFixtures(c_dir, scmlogs)
+        fixture.init()
+        scm_object           = Git(self.cli, self.tasks)
+        scm_object.clone_dir = fixture.repo_path
+        scm_object.arch_dir  = fixture.repo_path
+        outdir               = os.path.join(self.tmp_dir, cl_name, tc_name,
+                                            'out')
+        self.cli.outdir      = outdir
+        os.makedirs(outdir)
+        afile = os.path.join(fixture.repo_path, 'a')
+        mtime = os.lstat(afile).st_mtime
+
+        arch                 = ObsCpio()
+        arch.create_archive(
+            scm_object,
+            cli      = self.cli,
+            basename = 'test',
+            dstname  = 'test',
+            version  = '0.1.1'
+        )
+        self.assertEqual(os.lstat(afile).st_mtime, mtime)
+
+        with open(arch.archivefile, 'rb') as cpio:
+            data = cpio.read()
+        self.assertEqual(len(data) % 512, 0)
+
+        names  = []
+        offset = 0
+        while True:
+            header = data[offset:offset + 110]
+            self.assertEqual(header[:6], b'070701')
+            fields = [int(header[6 + i * 8:14 + i * 8], 16)
+                      for i in range(13)]
+            namesize = fields[11]
+            name = data[offset + 110:offset + 110 + namesize - 1]
+            if name == b'TRAILER!!!':
+                break
+            names.append(name.decode())
+            # uid, gid and mtime
+            self.assertEqual(fields[2:4], [0, 0])
+            self.assertEqual(fields[5], 1234567890)
+            offset += 110 + namesize
+            offset += -offset % 4
+            offset += fields[6] + (-fields[6] % 4)
+
+        self.assertEqual(names, sorted(names))
+        self.assertIn('repo/a', names)
+        self.assertIn('repo/subdir/b', names)
+        self.assertNotIn('repo/.git', names)
+
+    def test_filter_prunes_dirs(self):
+        '''
+        Test that excluded directories are not entered while walking the tree
+        '''
+        tc_name = inspect.stack()[0][3]
+        wdir    = os.path.join(self.tmp_dir, tc_name)
+        for fname in ['top/a', 'top/a.txt', 'top/node_modules/x/y',
+                      'top/src/b', 'top/src.o/c', 'top/.git/config']:
+            path = os.path.join(wdir, fname)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fhl:
+                fhl.write(fname)
+
+        cwd = os.getcwd()
+        os.chdir(wdir)
+        self.cli.exclude = ['node_modules']
+        walked = []
+        orig_prune = FileFilter.prune
+
+        def prune(ffilter, path):
+            walked.append(path)
+            return orig_prune(ffilter, path)
+
+        with mock.patch.object(FileFilter, 'prune', prune):
+            got = list(ObsCpio().filter_files('top', self.cli))
+        self.assertEqual(got, ['top/a', 'top/a.txt', 'top/src',
+                               'top/src.o', 'top/src.o/c', 'top/src/b'])
+        self.assertNotIn('top/node_modules/x', walked)
+
+        # a '$' anchor may exclude a directory but keep its content
+        self.cli.exclude = []
+        self.cli.exclude_re = r'.*\.o$'
+        got = list(ObsCpio().filter_files('top', self.cli))
+        os.chdir(cwd)
+        self.assertIn('top/src.o/c', got)
+        self.assertNotIn('top/src.o', got)
+
+    def test_filter_files_sorted_order(self):
+        '''
+        Test that the walk yields the paths in the order of sorted()
+        '''
+        tc_name = inspect.stack()[0][3]
+        wdir    = os.path.join(self.tmp_dir, tc_name)
+        for fname in ['top/a/x', 'top/a.txt', 'top/a-b/c', 'top/a0',
+                      'top/b/a/z', 'top/b/a.z', 'top/b/a_']:
+            path = os.path.join(wdir, fname)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fhl:
+                fhl.write(fname)
+        os.symlink('b', os.path.join(wdir, 'top', 'link'))
+
+        cwd = os.getcwd()
+        os.chdir(wdir)
+        got = list(ObsCpio().filter_files('top', self.cli))
+        expected = []
+        for root, dirs, files in os.walk('top'):
+            expected.extend(os.path.join(root, n) for n in dirs + files)
+        os.chdir(cwd)
+        self.assertEqual(got, sorted(expected))
+        self.assertIn('top/link', got)
+        self.assertNotIn('top/link/a', got)
+
+    def test_sparse_checkout_patterns(self):
+        '''
+        Test the translation of include/exclude into sparse-checkout patterns
+        '''
+        cases = [
+            ({}, []),
+            ({'include': ['src', 'doc/*.md']}, ['/src*', '/doc/*']),
+            ({'include': ['src', '*.c']}, []),
+            ({'include_re': r'lib/(a|b)'}, ['/lib/*']),
+            ({'include_re': r'src|lib'}, []),
+            ({'include_re': r'tests?/'}, ['/test*']),
+            ({'exclude': ['tests', 'a.o', 'doc/big']}, ['/*', '!/tests*']),
+            ({'exclude_re': r'tests'}, []),
+            ({'subdir': 'pkg', 'include': ['src']}, ['/pkg/src*']),
+            ({'subdir': 'pkg', 'exclude': ['tests']},
+             ['/pkg/*', '!/pkg/tests*']),
+        ]
+        for (options, expected) in cases:
+            self.cli.parse_args(['--outdir', '.'])
+            for (key, value) in options.items():
+                setattr(self.cli, key, value)
+            self.assertEqual(sparse_checkout_patterns(self.cli), expected,
+                             options)
@@ -17,6 +17,8 @@ class CommonTests(TestEnvironment, TestAssertions):
     system, and will be run for all of git / hg / svn / bzr.
     """
     scm = None
+    # whether a cached --revision (tag or commit id) is not fetched again
+    cached_revisions_immutable = False
 
     def basename(self, name='repo', version=None):
         if version is None:
@@ -282,7 +284,11 @@ class CommonTests(TestEnvironment, TestAssertions):
             logpath = self.scmlogs.current_log_path
             loglines = self.scmlogs.read()
 
-            if expect_cache_hit:
+            if expect_cache_hit and self.cached_revisions_immutable and \
+               '--revision' in args:
+                self.scmlogs.annotate("expected cache hit without fetch")
+                self.assertSkippedFetch(logpath, loglines)
+            elif expect_cache_hit:
                 self.scmlogs.annotate("expected cache hit")
                 self.assertRanUpdate(logpath, loglines)
             else:
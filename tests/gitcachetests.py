@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import fcntl
+import glob
+import json
+import os
+import tarfile
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from tests.testassertions import TestAssertions
+from tests.testenv        import TestEnvironment
+from tests.gitfixtures    import GitFixtures
+
+from TarSCM.archive       import Tar
+from TarSCM.cpio          import CpioWriter
+from TarSCM.helpers       import Helpers
+
+
+class GitCacheTests(TestEnvironment, TestAssertions):
+
+    """Unit tests for the caches of 'tar_scm --scm git'.
+
+    The repository cache (mirror, partial clones, fetch stamps) and the
+    artifact cache are covered here, the remaining git-specific tests
+    are in gittests.py.
+    """
+
+    scm = 'git'
+    initial_clone_command = 'git clone'
+    update_cache_command  = 'git fetch'
+    fixtures_class = GitFixtures
+
+    def basename(self, name='repo', version=None):
+        if version is None:
+            version = self.default_version()
+        return '%s-%s' % (name, version)
+
+    def default_version(self):
+        return "%s.%s" % (self.timestamps(self.rev(2)),
+                          self.abbrev_sha1s(self.rev(2)))
+
+    def rev(self, rev):
+        fix = self.fixtures
+        return fix.revs[fix.repo_path][rev]
+
+    def timestamps(self, rev):
+        fix = self.fixtures
+        return fix.timestamps[fix.repo_path][rev]
+
+    def abbrev_sha1s(self, rev):
+        fix = self.fixtures
+        return fix.sha1s[fix.repo_path][rev][0:7]
+
+    def test_working_copy_from_mirror(self):
+        # a --subdir which covers the whole tree uses the mirror cache
+        subdir = os.curdir
+        self.tar_scm_std('--subdir', subdir)
+        os.remove(os.path.join(self.outdir, os.listdir(self.outdir)[0]))
+
+        self.scmlogs.nextlog('warm-cache')
+        self.tar_scm_std('--subdir', subdir, '--revision', self.rev(2))
+        version = '%s.%s' % (self.timestamps(self.rev(2)).replace('-', ''),
+                             self.abbrev_sha1s(self.rev(2)))
+        self.assertTarOnly(self.basename(version=version))
+        clones = [line for line in self.scmlogs.read()
+                  if line.startswith('git clone')]
+        self.assertEqual(len(clones), 1)
+        self.assertIn('--shared', clones[0])
+        self.assertNotIn(self.fixtures.repo_url, clones[0])
+
+        # the working copy borrows the objects of the mirror
+        self.tar_scm_std('--subdir', subdir, '--skip-cleanup')
+        alternates = glob.glob(os.path.join(self.outdir, '*', 'repo', '.git',
+                                            'objects', 'info', 'alternates'))
+        self.assertEqual(len(alternates), 1)
+        mirror = glob.glob(os.path.join(self.cachedir, '*', 'repo'))[0]
+        with open(alternates[0]) as fhl:
+            self.assertEqual(fhl.read().strip(),
+                             os.path.join(mirror, 'objects'))
+
+    def test_sparse_subdir(self):
+        subdir = self.fixtures.subdir
+        Helpers().safe_run(['git', 'config', 'uploadpack.allowFilter', 'true'],
+                           self.fixtures.repo_path)
+        self.tar_scm_std('--subdir', subdir)
+        self.assertTarOnly(self.basename(), tarchecker=self.assertSubdirTar)
+        logs = self.scmlogs.read()
+        clones = [line for line in logs if line.startswith('git clone')]
+        self.assertEqual(len(clones), 2)
+        for clone in clones:
+            self.assertIn('--filter=blob:none', clone)
+            self.assertIn('--no-checkout', clone)
+        self.assertIn('git sparse-checkout set --cone %s\n' % subdir, logs)
+
+        # the cache itself never downloads any blob
+        caches = glob.glob(os.path.join(self.cachedir, '*-pc-blob', 'repo'))
+        self.assertEqual(len(caches), 1)
+        cmd = ['git', 'cat-file', '--batch-all-objects',
+               '--batch-check=%(objecttype)']
+        types = Helpers().safe_run(cmd, caches[0])[1].split()
+        self.assertIn('tree', types)
+        self.assertNotIn('blob', types)
+
+    def test_prefetch_objects(self):
+        Helpers().safe_run(['git', 'config', 'uploadpack.allowFilter', 'true'],
+                           self.fixtures.repo_path)
+        tag2 = self.rev(2)
+        # the cache only holds the trees and blobs of the newest commit
+        self.fixtures.create_commits(1)
+        self.tar_scm_std('--revision', tag2, '--version', tag2)
+        self.assertTarOnly(self.basename(version=tag2))
+        logs = self.scmlogs.read()
+        clones = [line for line in logs if line.startswith('git clone')]
+        self.assertIn('--filter=tree:0', clones[0])
+        # the trees of the working copy and then its blobs
+        fetches = [line for line in logs if '--stdin origin' in line]
+        self.assertEqual(len(fetches), 2)
+        self.assertIn('git rev-list --objects --no-walk --missing=print '
+                      '%s\n' % tag2, logs)
+
+    def test_unshallow_mirror(self):
+        # --subdir . uses the mirror
+        self.tar_scm_std('--subdir', os.curdir)
+        fetches = [line for line in self.scmlogs.read()
+                   if line.startswith('git fetch')]
+        self.assertNotIn('--depth', fetches[0])
+        mirrors = glob.glob(os.path.join(self.cachedir, '*', 'repo'))
+        self.assertEqual(len(mirrors), 1)
+        self.assertFalse(os.path.exists(os.path.join(mirrors[0], 'shallow')))
+
+        # mirrors of older versions might be shallow
+        Helpers().safe_run(['git', 'fetch', '--depth', '1', 'origin',
+                            '+refs/heads/*:refs/heads/*'], mirrors[0])
+        self.assertTrue(os.path.exists(os.path.join(mirrors[0], 'shallow')))
+        os.remove(os.path.join(self.outdir, self.basename() + '.tar'))
+        self.scmlogs.nextlog('unshallow')
+        self.tar_scm_std('--subdir', os.curdir)
+        self.assertTarOnly(self.basename())
+        fetches = [line for line in self.scmlogs.read()
+                   if line.startswith('git fetch')]
+        self.assertIn('--unshallow', fetches[0])
+        self.assertFalse(os.path.exists(os.path.join(mirrors[0], 'shallow')))
+
+    def test_mirror_refspecs(self):
+        fix = self.fixtures
+        os.chdir(fix.repo_path)
+        fix.safe_run('tag v1.0')
+        # refs/pull/* of a hosting service
+        fix.safe_run('update-ref refs/pull/1/head HEAD')
+        self.tar_scm_std('--subdir', os.curdir, '--match-tag', 'v*')
+        fetches = [line for line in self.scmlogs.read()
+                   if line.startswith('git fetch')]
+        self.assertEqual(len(fetches), 1)
+        self.assertIn(' origin +refs/heads/*:refs/heads/* '
+                      '+refs/tags/v*:refs/tags/v*\n', fetches[0])
+        mirror = glob.glob(os.path.join(self.cachedir, '*', 'repo'))[0]
+        refs = Helpers().safe_run(['git', 'for-each-ref',
+                                   '--format=%(refname)'], mirror)[1].split()
+        self.assertEqual(sorted(refs), ['refs/heads/master',
+                                        'refs/tags/v1.0'])
+
+        # an update only needs a single fetch as well
+        self.scmlogs.nextlog('update')
+        self.tar_scm_std('--subdir', os.curdir, '--revision',
+                         'refs/pull/1/head', '--version', '1')
+        # the working copy fetches the ref from the mirror afterwards
+        fetches = [line for line in self.scmlogs.read()
+                   if line.startswith('git fetch') and ' origin ' in line]
+        self.assertEqual(len(fetches), 1)
+        self.assertIn('+refs/pull/1/head:refs/pull/1/head', fetches[0])
+
+        # without 'refs/' the ref is fetched separately and follows updates
+        os.chdir(fix.repo_path)
+        fix.create_commits(1)
+        fix.safe_run('update-ref refs/pull/1/head HEAD')
+        head = Helpers().safe_run(['git', 'rev-parse', 'HEAD'],
+                                  fix.repo_path)[1].strip()
+        for _ in range(2):
+            self.tar_scm_std('--subdir', os.curdir, '--revision',
+                             'pull/1/head', '--version', '1')
+        refs = Helpers().safe_run(['git', 'for-each-ref',
+                                   '--format=%(objectname) %(refname)',
+                                   'refs/pull', 'refs/heads/pull'],
+                                  mirror)[1]
+        self.assertEqual(refs, '%s refs/pull/1/head\n' % head)
+
+    def test_sparse_include_exclude(self):
+        subdir = self.fixtures.subdir
+        expected = [self.basename(),
+                    self.basename() + '/' + subdir,
+                    self.basename() + '/' + subdir + '/b']
+        variants = [
+            (['--include', subdir], '--no-cone /%s*' % subdir),
+            (['--exclude', 'a', '--exclude', 'c'], '--no-cone /* !/a* !/c*'),
+        ]
+        for (args, patterns) in variants:
+            self.scmlogs.nextlog('sparse')
+            self.tar_scm_std(*args)
+            self.assertIn('git sparse-checkout set %s\n' % patterns,
+                          self.scmlogs.read())
+            tar_file = os.path.join(self.outdir, self.basename() + '.tar')
+            with tarfile.open(tar_file) as tar:
+                self.assertEqual(tar.getnames(), expected)
+
+    def test_unlock_before_archive(self):
+        locked = []
+
+        def check_lock(add):
+            def wrapper(*args):
+                lock = glob.glob(os.path.join(self.cachedir, '*', '.lock'))
+                with open(lock[0]) as lfh:
+                    try:
+                        fcntl.flock(lfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        locked.append(False)
+                    except (IOError, OSError):
+                        locked.append(True)
+                return add(*args)
+            return wrapper
+
+        with mock.patch.object(Tar, 'add_files', check_lock(Tar.add_files)):
+            self.tar_scm_std('--subdir', os.curdir, '--extension', 'tar')
+        # the archive is built from the copy of the working copy
+        self.assertEqual(locked, [False])
+
+        with mock.patch.object(Tar, 'add_objects',
+                               check_lock(Tar.add_objects)):
+            self.tar_scm_std('--subdir', os.curdir, '--extension', 'tar',
+                             '--stream-objects', 'enable')
+        # the objects are read from the mirror
+        self.assertEqual(locked, [False, True])
+
+        # the commit time is read before the cache gets unlocked
+        del locked[:]
+        with mock.patch.object(Helpers, 'get_timestamp',
+                               check_lock(Helpers.get_timestamp)), \
+                mock.patch.object(CpioWriter, 'add',
+                                  check_lock(CpioWriter.add)):
+            self.tar_scm_std('--subdir', os.curdir, '--use-obs-scm', 'True')
+        self.assertTrue(locked[0])
+        self.assertFalse(any(locked[1:]))
+        self.assertGreater(len(locked), 1)
+
+    def test_artifact_cache_disabled(self):
+        self.tar_scm_std('--extension', 'tar')
+        self.assertTarOnly(self.basename())
+        artifacts = os.path.join(self.cachedir, 'artifacts')
+        self.assertFalse(os.path.exists(artifacts))
+
+    @mock.patch.dict(os.environ, {'CACHE_ARTIFACTS': 'yes'})
+    def test_artifact_cache(self):
+        self.tar_scm_std('--extension', 'tar')
+        tar_file = os.path.join(self.outdir, self.basename() + '.tar')
+        artifacts = os.path.join(self.cachedir, 'artifacts')
+        entries = os.listdir(artifacts)
+        self.assertEqual(len(entries), 1)
+        cached = os.path.join(artifacts, entries[0], self.basename() + '.tar')
+        self.assertEqual(os.listdir(os.path.join(artifacts, entries[0])),
+                         [self.basename() + '.tar'])
+        with open(cached, 'rb') as fhl:
+            data = fhl.read()
+        with open(tar_file, 'rb') as fhl:
+            self.assertEqual(fhl.read(), data)
+
+        # an unchanged upstream is served from the cache
+        with open(cached, 'wb') as fhl:
+            fhl.write(b'cached')
+        self.tar_scm_std('--extension', 'tar')
+        with open(tar_file, 'rb') as fhl:
+            self.assertEqual(fhl.read(), b'cached')
+        # later services must not modify the cache entry
+        self.assertNotEqual(os.stat(tar_file).st_ino, os.stat(cached).st_ino)
+
+        # other parameters produce a new entry
+        self.tar_scm_std('--extension', 'tar', '--exclude', 'a')
+        self.assertEqual(len(os.listdir(artifacts)), 2)
+
+    def test_probe_remote(self):
+        self.tar_scm_std('--probe-remote', 'enable')
+        self.assertTarOnly(self.basename())
+        tar_file = os.path.join(self.outdir, self.basename() + '.tar')
+        os.remove(tar_file)
+
+        # an unchanged upstream only needs a 'git ls-remote'
+        self.scmlogs.nextlog('unchanged')
+        self.tar_scm_std('--probe-remote', 'enable')
+        self.assertTarOnly(self.basename())
+        logs = [line for line in self.scmlogs.read()
+                if not line.startswith('git --version')]
+        self.assertEqual(len(logs), 1)
+        self.assertTrue(logs[0].startswith('git ls-remote'))
+        os.remove(tar_file)
+
+        # a new commit upstream needs a complete run
+        self.fixtures.create_commits(1)
+        self.scmlogs.nextlog('changed')
+        self.tar_scm_std('--probe-remote', 'enable')
+        self.assertTarOnly(self.basename(version='%s.%s' % (
+            self.timestamps(self.rev(3)), self.abbrev_sha1s(self.rev(3)))))
+        fetches = [line for line in self.scmlogs.read()
+                   if line.startswith('git fetch')]
+        self.assertTrue(fetches)
+
+    @mock.patch.dict(os.environ, {'CACHE_FETCH_TTL': '3600'})
+    def test_fetch_ttl(self):
+        # --subdir . uses the mirror
+        self.tar_scm_std('--subdir', os.curdir)
+        self.assertTarOnly(self.basename())
+        stamps = glob.glob(os.path.join(self.cachedir, '*', '.fetched'))
+        self.assertEqual(len(stamps), 1)
+        os.remove(os.path.join(self.outdir, self.basename() + '.tar'))
+
+        # the cache has just been fetched
+        self.fixtures.create_commits(1)
+        self.scmlogs.nextlog('fresh')
+        self.tar_scm_std('--subdir', os.curdir)
+        self.assertTarOnly(self.basename())
+        self.assertSkippedFetch(self.scmlogs.current_log_path,
+                                self.scmlogs.read())
+        os.remove(os.path.join(self.outdir, self.basename() + '.tar'))
+
+        # ... until the TTL has expired
+        with open(stamps[0]) as stamp:
+            data = json.load(stamp)
+        data['time'] -= 3600
+        with open(stamps[0], 'w') as stamp:
+            json.dump(data, stamp)
+        self.scmlogs.nextlog('expired')
+        self.tar_scm_std('--subdir', os.curdir)
+        self.assertTarOnly(self.basename(version='%s.%s' % (
+            self.timestamps(self.rev(3)), self.abbrev_sha1s(self.rev(3)))))
+        self.assertRanUpdate(self.scmlogs.current_log_path,
+                             self.scmlogs.read())
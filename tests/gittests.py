@@ -2,6 +2,9 @@
 # -*- coding: UTF-8 -*-
 
 import datetime
+import glob
+import hashlib
+import json
 import os
 import re
 import tarfile
@@ -23,6 +26,8 @@ from tests.fake_classes import FakeCli, FakeTasks
 
 from TarSCM.helpers     import Helpers
 from TarSCM.scm.git     import Git
+from TarSCM.gitobjects  import GitTree, GitSession
+from TarSCM.signatures  import SignatureCache
 
 
 class GitTests(GitHgTests, GitSvnTests):
@@ -36,6 +41,7 @@ class GitTests(GitHgTests, GitSvnTests):
     scm = 'git'
     initial_clone_command = 'git clone'
     update_cache_command  = 'git fetch'
+    cached_revisions_immutable = True
     sslverify_false_args  = '--config http.sslverify=false'
     fixtures_class = GitFixtures
 
@@ -346,13 +352,23 @@ class GitTests(GitHgTests, GitSvnTests):
         clone_dir = '/tmp/clone_dir'
         git.url = clone_url
         git.clone_dir = clone_dir
-        with mock.patch.object(Helpers, 'safe_run') as mock_save_run:
+        git.run_and_hide = mock.MagicMock()
+        with mock.patch.object(Helpers, 'safe_run') as mock_save_run, \
+                mock.patch.object(Helpers, 'run_cmd', return_value=(1, '')):
             git.fetch_upstream_scm()
-            ((command,), kwargs) = mock_save_run.call_args  # noqa: E501 pylint: disable=W0612
-            expected_command = [
-                'git', '-c', 'http.proxy=http://myproxy', 'clone', '--mirror',
-                clone_url, clone_dir]
+            commands = [args[0] for (args, _) in
+                        mock_save_run.call_args_list]
+            git_cmd = ['git', '-c', 'http.proxy=http://myproxy']
+            self.assertEqual(commands[:2], [
+                git_cmd + ['init', '--bare', '--quiet', clone_dir],
+                git_cmd + ['config', '--local', 'remote.origin.url',
+                           clone_url]])
+            ((command, wdir), _) = git.run_and_hide.call_args
+            expected_command = git_cmd + [
+                'fetch', '--no-tags', 'origin',
+                '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
             self.assertEqual(expected_command, command)
+            self.assertEqual(wdir, clone_dir)
 
     def test_revision_latest_tag(self):
         fix = self.fixtures
@@ -554,11 +570,240 @@ class GitTests(GitHgTests, GitSvnTests):
         ]
 
         for case in expected:
-            rev = git.find_latest_signed_commit(case[0])
+            with mock.patch.object(git, '_verify_commit',
+                                   wraps=git._verify_commit) as verify:
+                rev = git.find_latest_signed_commit(case[0])
             self.assertEqual(rev, case[1])
+            # signatures are read from 'git log', only the ones the
+            # result is based on get verified again
+            if rev is None:
+                self.assertFalse(verify.called)
+            else:
+                self.assertTrue(verify.called)
 
         empty = git.merge_is_empty('181fb87')
         self.assertEqual(empty, 0)
 
         if org_gnupghome:
             os.environ["GNUPGHOME"] = org_gnupghome
+
+    def test_find_latest_signed_tag(self):
+        cln = self.__class__.__name__
+        basedir = os.path.abspath(os.path.dirname(__file__))
+        tar_path = os.path.join(basedir, 'fixtures', cln,
+                                'test_find_valid_commit', 'fixtures.tar')
+        basedir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+        org_gnupghome = os.getenv('GNUPGHOME')
+        os.environ["GNUPGHOME"] = os.path.join(basedir, '.gnupg')
+        with tarfile.open(tar_path, "r") as tar:
+            tar.extractall(basedir)
+
+        fix = self.fixtures
+        sign = '-c user.signingkey=20103E05D710AE2A644763C88201BA8C773A63AD '
+        fix.safe_run(sign + 'tag -s -m old v_old HEAD~3')
+        fix.safe_run(sign + 'tag -s -m signed v_signed HEAD~2')
+        fix.safe_run('tag -a -m unsigned v_unsigned HEAD~1')
+        fix.safe_run('tag v_light HEAD')
+
+        git = Git(FakeCli(), FakeTasks())
+        # two batches of two tags
+        with mock.patch('os.cpu_count', return_value=1):
+            self.assertEqual(git.find_latest_signed_tag(), 'v_signed')
+        self.assertEqual(git._parent_tag, 'v_signed')
+
+        fix.safe_run('tag -d v_old v_signed')
+        self.assertIsNone(git.find_latest_signed_tag())
+
+        if org_gnupghome:
+            os.environ["GNUPGHOME"] = org_gnupghome
+
+    def test_signature_cache(self):
+        cln = self.__class__.__name__
+        basedir = os.path.abspath(os.path.dirname(__file__))
+        tar_path = os.path.join(basedir, 'fixtures', cln,
+                                'test_find_valid_commit', 'fixtures.tar')
+        basedir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+        org_gnupghome = os.getenv('GNUPGHOME')
+        os.environ["GNUPGHOME"] = os.path.join(basedir, '.gnupg')
+        with tarfile.open(tar_path, "r") as tar:
+            tar.extractall(basedir)
+        asc = os.path.join(basedir, 'maintainers.asc')
+        Helpers().safe_run(['gpg', '--export', '--armor', '--output', asc],
+                           cwd=None)
+
+        f_args = FakeCli()
+        f_args.maintainers_asc = asc
+        git = Git(f_args, FakeTasks())
+        os.makedirs(git.repocachedir)
+
+        # the keyring is imported once into the cache
+        with open(asc, 'rb') as fhl:
+            digest = hashlib.sha256(fhl.read()).hexdigest()
+        gpgdir = os.path.join(self.cachedir, 'gnupg', digest)
+        self.assertEqual(os.listdir(os.path.dirname(gpgdir)), [digest])
+        self.assertTrue(os.path.isfile(os.path.join(gpgdir, 'gpg.conf')))
+        with mock.patch.object(Git, '_import_keys') as import_keys:
+            Git(f_args, FakeTasks())
+        self.assertFalse(import_keys.called)
+
+        cases = ['fb54afb594a0e27dc4047da8ddf2adbe8af60bb5',
+                 '82d3064bce8b38956956bbe3130495bd33502cb5',
+                 'b678c1654d9fb3e918e4a2147e7b7eb027176910']
+        expected = [git.find_latest_signed_commit(case) for case in cases]
+        self.assertEqual(expected,
+                         ['2169a7524bb39ba9e0e619ec41f50132c1075a5c',
+                          '2169a7524bb39ba9e0e619ec41f50132c1075a5c',
+                          None])
+        cache_file = os.path.join(git.repocachedir, 'signatures.json')
+        self.assertTrue(os.path.isfile(cache_file))
+
+        # the results do not depend on gpg anymore
+        empty_home = os.path.join(basedir, 'empty-gnupg')
+        os.mkdir(empty_home, 0o700)
+        os.environ["GNUPGHOME"] = empty_home
+        self.assertEqual(
+            [git.find_latest_signed_commit(case) for case in cases],
+            expected)
+
+        # another keyring drops the cached results
+        with open(asc, 'a') as fhl:
+            fhl.write('\n')
+        self.assertEqual(SignatureCache(cache_file, asc).results, {})
+
+        if org_gnupghome:
+            os.environ["GNUPGHOME"] = org_gnupghome
+
+    def test_revision_info_memo(self):
+        vfmt = '@PARENT_TAG@.@TAG_OFFSET@'
+        self.tar_scm_std('--versionformat', vfmt)
+        self.assertTarOnly(self.basename(version=self.rev(2) + '.0'))
+        memos = glob.glob(os.path.join(self.cachedir, '*', 'revinfo',
+                                       '*.json'))
+        self.assertEqual(len(memos), 1)
+        self.assertEqual(os.path.basename(memos[0]),
+                         self.sha1s(self.rev(2)) + '.json')
+        with open(memos[0]) as fhl:
+            data = json.load(fhl)
+        self.assertEqual(data['parent_tag'], self.rev(2))
+        self.assertEqual(data['tag_offsets'], {self.rev(2): '0'})
+        self.assertEqual(str(data['commit_time']),
+                         self.timestamps(self.rev(2)))
+
+        # later runs use the memo as long as the tags are unchanged
+        for (tags, version) in [(data['tags'], 'memo.7'),
+                                ('other', self.rev(2) + '.0')]:
+            data.update({'parent_tag': 'memo', 'tags': tags,
+                         'tag_offsets': {'memo': '7'}})
+            with open(memos[0], 'w') as fhl:
+                json.dump(data, fhl)
+            os.remove(os.path.join(self.outdir, os.listdir(self.outdir)[0]))
+            self.tar_scm_std('--versionformat', vfmt)
+            self.assertTarOnly(self.basename(version=version))
+
+    def test_shallow_clone(self):
+        self.disableCache()
+        self.tar_scm_std('--revision', self.rev(2), '--version', '2')
+        self.assertTarOnly(self.basename(version='2'))
+        clones = [line for line in self.scmlogs.read()
+                  if line.startswith('git clone')]
+        self.assertIn('--depth 1 --branch %s' % self.rev(2), clones[0])
+
+        # the history is deepened step by step until the parent tag is
+        # reached
+        os.chdir(self.fixtures.wdir)
+        for _ in range(3):
+            self.fixtures.safe_run('commit --allow-empty -m untagged')
+        self.scmlogs.nextlog('parent-tag')
+        self.tar_scm_std('--versionformat', '@PARENT_TAG@.@TAG_OFFSET@')
+        self.assertTarOnly(self.basename(version=self.rev(2) + '.3'))
+        fetches = [line.split(' ')[1:3] for line in self.scmlogs.read()
+                   if line.startswith('git fetch')]
+        self.assertEqual(fetches, [['fetch', '--deepen=1'],
+                                   ['fetch', '--deepen=2']])
+
+    def test_stream_objects(self):
+        os.chdir(self.fixtures.wdir)
+        os.symlink('subdir/b', 'link')
+        self.fixtures.safe_run('add link')
+        self.fixtures.safe_run('commit -m "add link"')
+        os.chmod('a', 0o755)
+        self.fixtures.safe_run('commit -a -m "make a executable"')
+
+        variants = [
+            [],
+            ['--subdir', '.'],
+            ['--subdir', '.', '--exclude', 'subdir'],
+            ['--subdir', 'subdir', '--extension', 'tar.gz'],
+            ['--subdir', '.', '--use-obs-scm', 'True'],
+            ['--subdir', 'subdir', '--use-obs-scm', 'True'],
+        ]
+        for args in variants:
+            results = []
+            for stream in ['disable', 'enable']:
+                with mock.patch.object(GitTree, 'walk', autospec=True,
+                                       side_effect=GitTree.walk) as walk:
+                    self.tar_scm_std('--stream-objects', stream, *args)
+                self.assertEqual(walk.called, stream == 'enable')
+                archives = [f for f in os.listdir(self.outdir)
+                            if re.search(r'\.(tar|tar\.gz|obscpio)$', f)]
+                self.assertEqual(len(archives), 1)
+                with open(os.path.join(self.outdir, archives[0]), 'rb') as fhl:
+                    results.append(fhl.read())
+            self.assertEqual(results[0], results[1], args)
+
+    def test_stream_objects_fallback(self):
+        with mock.patch.object(GitTree, 'walk', autospec=True,
+                               side_effect=GitTree.walk) as walk:
+            self.tar_scm_std('--stream-objects', 'enable', '--subdir', '.',
+                             '--package-meta', 'yes')
+        self.assertFalse(walk.called)
+
+    def test_git_session(self):
+        fix     = self.fixtures
+        tag2    = self.rev(2)
+        parent  = fix.get_metadata('%P')
+        session = GitSession(['git'], fix.repo_path)
+        try:
+            self.assertEqual(session.rev_parse(tag2 + '^{commit}'),
+                             self.sha1s(tag2))
+            self.assertEqual(session.rev_parse(parent), parent)
+            self.assertIsNone(session.rev_parse('does-not-exist'))
+            self.assertIsNone(session.rev_parse(tag2 + '\nHEAD'))
+
+            commit = session.commit(tag2)
+            self.assertEqual(commit['sha'], self.sha1s(tag2))
+            self.assertEqual(commit['parents'], [parent])
+            self.assertEqual(str(commit['committer_time']),
+                             self.timestamps(tag2))
+            self.assertEqual(session.commit(parent)['parents'], [])
+            self.assertIsNone(session.commit('does-not-exist'))
+        finally:
+            session.close()
+
+    def test_checksum(self):
+        for args in [['--extension', 'tar.gz'], ['--use-obs-scm', 'True']]:
+            self.tar_scm_std('--checksum', 'sha256', '--checksum', 'blake2b',
+                             *args)
+            archive = [f for f in os.listdir(self.outdir)
+                       if f.endswith('.tar.gz') or f.endswith('.obscpio')]
+            self.assertEqual(len(archive), 1)
+            fname = os.path.join(self.outdir, archive[0])
+            with open(fname, 'rb') as fhl:
+                data = fhl.read()
+            checksums = []
+            for algo in ['sha256', 'blake2b']:
+                digest = hashlib.new(algo, data).hexdigest()
+                with open(fname + '.' + algo) as fhl:
+                    self.assertEqual(fhl.read(),
+                                     '%s  %s\n' % (digest, archive[0]))
+                checksums.append(algo + ':' + digest)
+
+        with open(os.path.join(self.outdir, 'repo.obsinfo')) as fhl:
+            self.assertIn('checksum: ' + ' '.join(checksums) + '\n',
+                          fhl.read())
+
+    def test_tar_extension_compressed(self):
+        self.tar_scm_std('--extension', 'tar.gz')
+        tar_file = os.path.join(self.outdir, self.basename() + '.tar.gz')
+        with tarfile.open(tar_file, 'r:gz') as tar:
+            self.assertIn(self.basename() + '/a', tar.getnames())
@@ -13,6 +13,7 @@ import sys
 import unittest
 
 from tests.gittests import GitTests
+from tests.gitcachetests import GitCacheTests
 from tests.svntests import SvnTests
 from tests.hgtests  import HgTests
 from tests.bzrtests import BzrTests
@@ -34,7 +35,7 @@ def prepare_testclasses():
         # If you are only interested in a particular VCS, you can
         # temporarily comment out any of these or use the env variable
         # TAR_SCM_TC=<comma_separated_list> test.py
-        # export TAR_SCM_TC=UnitTestCases,TasksTestCases,SCMBaseTestCases,GitTests,SvnTests,TarTestCases # noqa # pylint: disable=line-too-long
+        # export TAR_SCM_TC=UnitTestCases,TasksTestCases,SCMBaseTestCases,GitTests,GitCacheTests,SvnTests,TarTestCases # noqa # pylint: disable=line-too-long
         HgTests,  # disabled because of a lack of performance
         BzrTests, # disabled as bzr is no longer part of Factory
         UnitTestCases,
@@ -42,6 +43,7 @@ def prepare_testclasses():
         ArchiveOBSCpioTestCases,
         SCMBaseTestCases,
         GitTests,
+        GitCacheTests,
         SvnTests,
         TarTestCases
     ]
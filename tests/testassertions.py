@@ -133,11 +133,22 @@ class TestAssertions(unittest.TestCase):
     def assertRanUpdate(self, logpath, loglines):
         # exception for git - works different in cached mode
         should_not_find = self.initial_clone_command
-        if self.__class__.__name__ == 'GitTests':
+        if self.__class__.__name__ in ('GitTests', 'GitCacheTests'):
             should_not_find = None
         self._find(logpath, loglines,
                    self.update_cache_command, should_not_find)
 
+    def assertSkippedFetch(self, logpath, loglines):
+        msg = "Shouldn't fetch in %s; log was:\n----\n%s\n----\n" % \
+            (logpath, "".join(loglines))
+        should_not_find = [self.update_cache_command]
+        # exception for git - works different in cached mode
+        if self.__class__.__name__ not in ('GitTests', 'GitCacheTests'):
+            should_not_find.append(self.initial_clone_command)
+        for line in loglines:
+            for term in should_not_find:
+                self.assertNotRegex(line, '^' + term, msg)
+
     def assertTarIsDeeply(self, tar, expected):
         if not os.path.isfile(tar):
             print("File '%s' not found" % tar)
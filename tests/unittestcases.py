@@ -5,6 +5,11 @@ import os
 import re
 import inspect
 import copy
+import fcntl
+import gzip
+import io
+import lzma
+import tarfile
 import unittest
 
 try:
@@ -16,9 +21,12 @@ from utils import file_write_legacy
 
 import TarSCM
 
-from TarSCM.helpers import Helpers
+from TarSCM.helpers import Helpers, copy_file_data, copy_sparse_data, \
+    data_segments, KERNEL_COPY_MIN
 from TarSCM.config  import Config
 from TarSCM.changes import Changes
+from TarSCM.compress import ParallelCompressor
+from TarSCM.materialize import Materializer
 from TarSCM.scm.git import Git
 from TarSCM.scm.svn import Svn
 from TarSCM.scm.hg  import Hg
@@ -56,6 +64,31 @@ class UnitTestCases(unittest.TestCase):
             self.assertTrue(scm.clone_dir.endswith('/repo'))
             self.tasks.cleanup()
 
+    def test_choose_clone_filter(self):
+        # pylint: disable=protected-access
+        scm              = Git(self.cli, self.tasks)
+        scm.basename     = 'repo'
+        scm.repocachedir = os.path.join(self.tmp_dir,
+                                        'test_choose_clone_filter')
+        cases = [
+            ({}, 'tree:0'),
+            ({'subdir': 'subdir'}, 'blob:none'),
+            ({'include': ['src']}, 'blob:none'),
+            ({'subdir': os.curdir}, None),
+            ({'package_meta': True}, None),
+        ]
+        for (options, expected) in cases:
+            self.cli.parse_args(['--outdir', '.'])
+            for (key, value) in options.items():
+                setattr(self.cli, key, value)
+            scm.sparse_checkout = scm._sparse_checkout_args()
+            self.assertEqual(scm._choose_clone_filter(), expected, options)
+
+        # an existing mirror is updated instead of cloning again
+        self.cli.parse_args(['--outdir', '.'])
+        os.makedirs(os.path.join(scm.repocachedir, 'repo'))
+        self.assertIsNone(scm._choose_clone_filter())
+
     @patch('TarSCM.Helpers.safe_run')
     def test__git_log_cmd_with_args(self, safe_run_mock):
         scm     = Git(self.cli, self.tasks)
@@ -88,6 +121,19 @@ class UnitTestCases(unittest.TestCase):
             cwd=None,
         )
 
+    def test_stream_cmd(self):
+        helpers = Helpers()
+        lines = helpers.stream_cmd(['seq', '1000000'], cwd=None)
+        self.assertEqual([next(lines), next(lines)], ['1', '2'])
+        # closing the generator terminates the command
+        lines.close()
+        self.assertRaisesRegex(
+            SystemExit,
+            re.compile(r"Command \['/bin/false'\] failed\(1\): ''"),
+            list,
+            helpers.stream_cmd(['/bin/false'], cwd=None),
+        )
+
     def test_config_files_ordering(self):
         tc_name = inspect.stack()[0][3]
         files = [
@@ -355,9 +401,173 @@ class UnitTestCases(unittest.TestCase):
         self.assertEqual(chgv, version)
 
     def test_cache_locking(self):
+        cachedir = os.path.join(self.tmp_dir, 'cache-locking')
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
         scm     = Git(self.cli, self.tasks)
-        scm.clone_dir = '.'
+        scm.repocachedir = cachedir
+        scm.clone_dir = os.path.join(cachedir, 'repo')
+        fname = os.path.join(cachedir, '.lock')
+
+        def try_lock(operation):
+            fdesc = os.open(fname, os.O_RDONLY)
+            try:
+                fcntl.flock(fdesc, operation | fcntl.LOCK_NB)
+                return True
+            except (IOError, OSError):
+                return False
+            finally:
+                os.close(fdesc)
+
         scm.lock_cache()
-        fname = scm.lock_file.name
+        with open(fname) as lfh:
+            self.assertEqual(lfh.read(), '%d\n' % os.getpid())
+        self.assertFalse(try_lock(fcntl.LOCK_SH))
+
+        # readers share the lock, but keep out a fetch
+        scm.lock_cache(exclusive=False)
+        self.assertTrue(try_lock(fcntl.LOCK_SH))
+        self.assertFalse(try_lock(fcntl.LOCK_EX))
+
+        # the lock file is kept for runs waiting on it
         scm.unlock_cache()
-        assert os.path.exists(fname) == 0
+        self.assertTrue(os.path.exists(fname))
+        self.assertTrue(try_lock(fcntl.LOCK_EX))
+
+    def test_parallel_compressor(self):
+        data = b''.join(b'%d\n' % i for i in range(300000))
+        for (ext, decompress) in [('tar.gz', gzip.decompress),
+                                  ('tar.xz', lzma.decompress)]:
+            results = []
+            for workers in (1, 4):
+                out = io.BytesIO()
+                comp = ParallelCompressor(out, ext, workers=workers)
+                comp.write(data[:1000])
+                comp.write(data[1000:])
+                self.assertEqual(comp.tell(), len(data))
+                comp.close()
+                results.append(out.getvalue())
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(decompress(results[0]), data)
+
+    def test_parallel_compressor_limits(self):
+        # the workers don't follow the CPUs of big build hosts
+        with patch('os.cpu_count', return_value=64):
+            for (ext, workers) in [('tar.gz', 8), ('tar.xz', 3),
+                                   ('tar.zst', 4)]:
+                comp = ParallelCompressor(io.BytesIO(), ext)
+                self.assertEqual(comp.workers, workers)
+                comp.abort()
+
+        out = io.BytesIO()
+        comp = ParallelCompressor(out, 'tar.gz', workers=2)
+        comp.write(b'x' * (comp.blocksize * 4 + 1))
+        with patch.object(out, 'write', side_effect=IOError("disk full")):
+            self.assertRaises(IOError, comp.close)
+        # the workers have been stopped and the blocks dropped
+        self.assertFalse(comp.pending)
+        self.assertRaises(RuntimeError, comp.executor.submit, len, b'')
+
+    def test_copy_file_data(self):
+        tc_name = inspect.stack()[0][3]
+        cl_name = self.__class__.__name__
+        wdir    = os.path.join(self.tmp_dir, cl_name, tc_name)
+        os.makedirs(wdir)
+        src_name = os.path.join(wdir, 'src')
+        dst_name = os.path.join(wdir, 'dst')
+        data = os.urandom(300000)
+        with open(src_name, 'wb') as src:
+            src.write(data)
+
+        with open(src_name, 'rb', buffering=0) as src, \
+                open(dst_name, 'wb') as dst, \
+                patch('os.copy_file_range',
+                      side_effect=os.copy_file_range) as cfr_mock:
+            dst.write(b'header')
+            self.assertEqual(copy_file_data(src, dst, len(data)), len(data))
+            dst.write(b'trailer')
+            self.assertTrue(cfr_mock.called)
+        with open(dst_name, 'rb') as dst:
+            self.assertEqual(dst.read(), b'header' + data + b'trailer')
+
+        # small files are copied through the buffer
+        with open(src_name, 'rb', buffering=0) as src, \
+                open(dst_name, 'wb') as dst, \
+                patch('os.copy_file_range') as cfr_mock:
+            size = KERNEL_COPY_MIN - 1
+            self.assertEqual(copy_file_data(src, dst, size), size)
+            self.assertFalse(cfr_mock.called)
+        with open(dst_name, 'rb') as dst:
+            self.assertEqual(dst.read(), data[:size])
+
+        # buffered fallback for file objects without a file descriptor
+        out = io.BytesIO()
+        with open(src_name, 'rb', buffering=0) as src:
+            self.assertEqual(copy_file_data(src, out, 1000), 1000)
+        self.assertEqual(out.getvalue(), data[:1000])
+
+    def test_sparse_files(self):
+        tc_name = inspect.stack()[0][3]
+        cl_name = self.__class__.__name__
+        wdir    = os.path.join(self.tmp_dir, cl_name, tc_name)
+        os.makedirs(wdir)
+        os.chdir(wdir)
+        with open('sparse', 'wb') as fhl:
+            fhl.write(b'x' * 4096)
+            fhl.seek(16 * 1024 * 1024)
+            fhl.write(b'y' * 4096)
+            fhl.truncate(32 * 1024 * 1024)
+        with open('sparse', 'rb') as fhl:
+            data = fhl.read()
+
+        with open('sparse', 'rb', buffering=0) as src:
+            segments = data_segments(src.fileno(), len(data))
+            self.assertEqual(src.tell(), 0)
+            out = io.BytesIO()
+            self.assertEqual(copy_sparse_data(src, out, len(data)),
+                             len(data))
+        self.assertEqual(out.getvalue(), data)
+
+        for sparse in [False, True]:
+            out = io.BytesIO()
+            with tarfile.open(fileobj=out, mode='w') as tar:
+                TarSCM.archive.Tar().add_entry(tar, 'sparse', lambda t: t,
+                                               sparse)
+            out.seek(0)
+            with tarfile.open(fileobj=out, mode='r') as tar:
+                self.assertEqual(tar.getnames(), ['sparse'])
+                self.assertEqual(tar.extractfile('sparse').read(), data)
+            if sparse and segments and len(segments) > 1:
+                self.assertLess(len(out.getvalue()), 1024 * 1024)
+
+    def test_materializer_copy_tree(self):
+        tc_name = inspect.stack()[0][3]
+        cl_name = self.__class__.__name__
+        wdir    = os.path.join(self.tmp_dir, cl_name, tc_name)
+        src     = os.path.join(wdir, 'src')
+        os.makedirs(os.path.join(src, 'subdir'))
+        file_write_legacy(os.path.join(src, 'a'), 'a')
+        file_write_legacy(os.path.join(src, 'subdir', 'b'), 'b')
+        os.symlink('subdir', os.path.join(src, 'link'))
+        os.chmod(os.path.join(src, 'a'), 0o750)
+        os.utime(os.path.join(src, 'subdir'), (1234567890, 1234567890))
+
+        for (hardlink, name) in [(False, 'copy'), (True, 'link')]:
+            dst = os.path.join(wdir, name)
+            engine = Materializer(hardlink=hardlink)
+            # force the fallbacks on filesystems with reflink support
+            engine.use_reflink = False
+            engine.copy_tree(src, dst)
+
+            self.assertEqual(os.readlink(os.path.join(dst, 'link')),
+                             'subdir')
+            with open(os.path.join(dst, 'subdir', 'b')) as fhl:
+                self.assertEqual(fhl.read(), 'b')
+            a_src = os.stat(os.path.join(src, 'a'))
+            a_dst = os.stat(os.path.join(dst, 'a'))
+            self.assertEqual(a_dst.st_mode, a_src.st_mode)
+            self.assertEqual(a_dst.st_ino == a_src.st_ino, hardlink)
+            self.assertEqual(
+                os.stat(os.path.join(dst, 'subdir')).st_mtime, 1234567890)
+
+        self.assertRaises(OSError, Materializer().copy_tree, src, dst)